@@ -1,6 +1,7 @@
 #!/bin/bash
 # acrontab -e
 # enter: 0 6 * * * /afs/cern.ch/user/k/kiesel/alignment/timeEvolution/acronExe.sh
+# alternatively keep "python watch.py" running to process new runs within minutes
 
 source userEnvironment.config 
 
@@ -14,6 +15,7 @@ source $VO_CMS_SW_DIR/cmsset_default.sh >> $logFile 2>&1
 cd /cvmfs/cms.cern.ch/slc6_amd64_gcc530/cms/cmssw/CMSSW_8_0_12 >> $logFile 2>&1
 eval `scramv1 runtime -sh` >> $logFile 2>&1
 cd ${WORKING_DIRECTORY} >> $logFile 2>&1
-python makePlots.py >> $logFile 2>&1
+mkdir -p reports >> $logFile 2>&1
+python makePlots.py --report reports/report_$(date +%F).json >> $logFile 2>&1
 
 
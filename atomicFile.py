@@ -0,0 +1,26 @@
+#!/usr/bin/env python2
+# Replacing files such that readers, also in other processes, see either the
+# old or the complete new content: the data is written to a temporary file in
+# the same directory, which is then renamed over the target.
+
+import os
+import tempfile
+
+_umask = os.umask(0)
+os.umask(_umask)
+
+def writeAtomic(filename, write, mode="w"):
+    """
+    Calls write(f) with a new temporary file next to filename and renames it
+    to filename afterwards. The temporary name is unique, so several threads
+    or processes may write the same file at once, the last rename wins.
+    """
+    fd, tmpName = tempfile.mkstemp(prefix=os.path.basename(filename) + ".", suffix=".tmp", dir=os.path.dirname(filename) or ".")
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.chmod(tmpName, 0666 & ~_umask) # mkstemp creates files only the owner can read
+        os.rename(tmpName, filename)
+    except:
+        os.remove(tmpName)
+        raise
@@ -0,0 +1,170 @@
+#!/usr/bin/env python2
+# Scaling benchmark of the plotting pipeline on synthetic run histories.
+# For each history size a fresh process creates Run*.root files (including
+# empty ones, which trip the GetSize()<5000 guard), stub das_client, conddb
+# and brilcalc executables, and times the stages of makePlots.
+# Usage: python benchmarks/pipeline.py [--runs 100,1000,10000] [--draw 20] [--output results.json]
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import resource
+import subprocess
+
+baseDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+firstRun = 278888
+
+# FIRSTRUN and LASTRUN are replaced in the stub scripts below
+dasStub = r'''
+import sys, json
+q = sys.argv[sys.argv.index("--query")+1]
+first, last = [int(x) for x in q.split("[")[1].split("]")[0].split(",")]
+data = [{"run": [{"run_number": r, "start_time": "2016-08-16 00:00:00",
+    "end_time": "2016-%02d-%02d %02d:00:00" % (8 + (r-FIRSTRUN)/3000 % 4, 1 + (r/100) % 28, r % 24),
+    "bfield": 3.8}]} for r in range(first, last+1) if r % 7]
+print json.dumps({"status": "ok", "data": data})
+'''
+
+conddbStub = r'''
+print "Since: Run   Insertion Time       Payload                                   Object Type"
+print "-----------  -------------------  ----------------------------------------  -------------"
+for r in range(FIRSTRUN, LASTRUN, 250):
+    print "%d  2016-08-16 00:00:00  0123456789abcdef0123456789abcdef01234567  Alignments" % r
+'''
+
+brilcalcStub = r'''
+import sys
+begin = int(sys.argv[sys.argv.index("--begin")+1])
+end = int(sys.argv[sys.argv.index("--end")+1]) if "--end" in sys.argv else LASTRUN
+print "#run:fill,time,nls,ncms,delivered(/fb),recorded(/fb)"
+for r in range(begin, end+1):
+    if r % 3: print "%d:5000,08/16/16 00:00:00,100,100,0.02,0.019" % r
+'''
+
+def writeStubs(binDir):
+    paths = {}
+    for name, content in [("das_client", dasStub), ("conddb", conddbStub), ("brilcalc", brilcalcStub)]:
+        paths[name] = os.path.join(binDir, name)
+        with open(paths[name], "w") as f:
+            f.write("#!" + sys.executable)
+            f.write(content.replace("FIRSTRUN", str(firstRun)).replace("LASTRUN", str(firstRun + 20000)))
+        os.chmod(paths[name], 0755)
+    return paths
+
+def createRunFiles(ROOT, folder, nRuns, seed=1):
+    """Six parameter histograms per run, every 50th file is empty."""
+    import numpy
+    rng = numpy.random.RandomState(seed)
+    params = ["Xpos", "Ypos", "Zpos", "Xrot", "Yrot", "Zrot"]
+    cuts = [5, 10, 15, 30, 30, 30]
+    for i in range(nRuns):
+        run = firstRun + i
+        f = ROOT.TFile(os.path.join(folder, "Run{}.root".format(run)), "recreate")
+        if i % 50 != 49:
+            for p, cut in zip(params, cuts):
+                h = ROOT.TH1F(p, "", 8, 0, 8)
+                for b in range(1, 7):
+                    h.SetBinContent(b, rng.normal(0, cut))
+                    h.SetBinError(b, abs(rng.normal(cut/3., cut/10.)))
+                h.SetBinContent(8, cut)
+                h.Write()
+        f.Close()
+
+class Stages:
+    def __init__(self):
+        self.results = []
+
+    def run(self, name, func, *args):
+        start = time.time()
+        result = func(*args)
+        self.results.append((name, time.time() - start))
+        return result
+
+def benchmark(nRuns, nDraw):
+    workDir = tempfile.mkdtemp(prefix="pixAliBench")
+    try:
+        binDir = os.path.join(workDir, "bin")
+        os.makedirs(binDir)
+        stubs = writeStubs(binDir)
+        os.environ["DAS_CLIENT"] = stubs["das_client"]
+        os.environ["BRILCALC"] = stubs["brilcalc"]
+        os.environ["PATH"] = binDir + os.pathsep + os.environ["PATH"]
+        os.chdir(workDir)
+        os.makedirs("root-files")
+        os.makedirs("plots")
+        sys.path.insert(0, baseDir)
+        import makePlots
+        makePlots.plotDir = os.path.join(workDir, "plots")
+
+        stages = Stages()
+        start = time.time()
+        stages.run("create files", createRunFiles, makePlots.ROOT, "root-files", nRuns)
+        store = stages.run("getInputHists (cold)", makePlots.getParameterStore)
+        store = stages.run("getInputHists (warm)", makePlots.getParameterStore)
+        stages.run("exceedsCuts (all runs)", makePlots.getCutStatus, store)
+        drawRuns = [r.run for r in store.records()][:nDraw]
+        hmaps = [makePlots.histsFromStore(store, run) for run in drawRuns]
+        stages.run("exceedsCuts (per histogram, {} runs)".format(len(drawRuns)),
+            lambda: [makePlots.exceedsCuts(h) for hmap in hmaps for h in hmap.values()])
+        stages.run("getUpdateRuns", makePlots.getUpdateRuns, "TrackerAlignment_PCL_byRun_v0_express")
+        series = stages.run("getGraphsVsRun (series)", makePlots.ParameterSeries, store.records(), firstRun)
+        stages.run("run metadata", makePlots.dasClient.prefetchRunInfos, [int(r) for r in series.runs])
+        graphsVsRun = stages.run("getGraphsVsRun (run)", makePlots.getGraphsVsRun, series)
+        graphsVsTime = stages.run("getGraphsVsRun (time)", makePlots.getGraphsVsRun, series, True)
+        stages.run("drawHists ({} runs)".format(len(drawRuns)), makePlots.renderRuns, drawRuns)
+        magnetGraph = makePlots.GetFieldHistoryByHand()
+        stages.run("drawGraphsVsX (run)", makePlots.drawGraphsVsX, graphsVsRun, "run", "vsRun", magnetGraph, makePlots.parameters, makePlots.objects)
+        magnetGraph = makePlots.GetFieldHistoryByHand(convertToTime=True)
+        stages.run("drawGraphsVsX (time)", makePlots.drawGraphsVsX, graphsVsTime, "time", "vsTime", magnetGraph, makePlots.parameters, makePlots.objects)
+        stages.run("getTableString", makePlots.getTableString, store.records(reverse=True))
+        template = os.path.join(baseDir, "indexTemplate.html")
+        stages.run("updateIndex (cold)", makePlots.updateIndex, store, template, workDir)
+        stages.run("updateIndex (warm)", makePlots.updateIndex, store, template, workDir)
+        return {
+            "runs": nRuns,
+            "wallTime": time.time() - start,
+            "peakRSSMB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+            "stages": stages.results,
+        }
+    finally:
+        if "makePlots" in sys.modules:
+            sys.modules["makePlots"].runDB.flushAll() # otherwise written at exit into baseDir
+        os.chdir(baseDir)
+        shutil.rmtree(workDir)
+
+def printResult(result):
+    print "{} runs: wall time {:.1f}s, peak RSS {:.0f} MB".format(result["runs"], result["wallTime"], result["peakRSSMB"])
+    for name, t in result["stages"]:
+        print "    {:45} {:8.3f}s".format(name, t)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", default="100,1000,10000", help="Comma separated history sizes")
+    parser.add_argument("--draw", type=int, default=20, help="Number of runs for which drawHists is timed")
+    parser.add_argument("--output", help="Write the results as json to this file")
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS) # internal: one size in this process
+    args = parser.parse_args()
+
+    if args.single:
+        with open(os.devnull, "w") as devnull:
+            stdout = os.dup(1)
+            os.dup2(devnull.fileno(), 1) # the pipeline prints a lot
+            try:
+                result = benchmark(args.single, args.draw)
+            finally:
+                sys.stdout.flush()
+                os.dup2(stdout, 1)
+        print json.dumps(result)
+    else:
+        results = []
+        for n in [int(x) for x in args.runs.split(",")]:
+            out = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--single", str(n), "--draw", str(args.draw)])
+            results.append(json.loads(out.strip().split("\n")[-1]))
+            printResult(results[-1])
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
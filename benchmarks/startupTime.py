@@ -0,0 +1,37 @@
+#!/usr/bin/env python2
+# Measures how long it takes to import the modules of this package and to
+# decide that there is nothing to do, each in a fresh interpreter.
+# Usage: python benchmarks/startupTime.py [--repeat N]
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+baseDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+snippets = [
+    ("import makePlots", "import makePlots"),
+    ("import downloadViaJson", "import downloadViaJson"),
+    ("import updateDB", "import updateDB"),
+    ("check for new runs", "import makePlots; makePlots.getParameterStore()"),
+]
+
+def timeSnippet(code, repeat):
+    # the snippet reports whether ROOT was loaded, which should not be the case
+    code += "; from lazyROOT import ROOT; print ROOT.isLoaded()"
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        out = subprocess.check_output([sys.executable, "-c", code], cwd=baseDir)
+        times.append(time.time() - start)
+    return times, out.strip().split("\n")[-1] == "True"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", "-n", type=int, default=5)
+    args = parser.parse_args()
+    for name, code in snippets:
+        times, rootLoaded = timeSnippet(code, args.repeat)
+        print "{:25} min {:6.3f}s mean {:6.3f}s{}".format(name, min(times), sum(times)/len(times), "  (ROOT loaded)" if rootLoaded else "")
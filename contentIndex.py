@@ -0,0 +1,79 @@
+#!/usr/bin/env python2
+# Sidecar index written next to every downloaded ROOT file (RunX.root.json)
+# with the names, types and sizes of the objects it contains, whether it is
+# empty, and size and checksum of the file. Loaders use it to skip empty or
+# invalid files without opening them with ROOT.
+
+import os
+import json
+import hashlib
+
+import atomicFile
+
+nParameters = 6 # a valid file contains the six parameter histograms
+minSize = 5000 # bytes, smaller DQM files are empty
+
+def sidecarName(filename):
+    return filename + ".json"
+
+def fileChecksum(filename):
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), ""):
+            h.update(block)
+    return h.hexdigest()
+
+class ContentRecorder:
+    """Collects the entries of one file while it is written."""
+    def __init__(self):
+        self.objects = []
+
+    def add(self, item):
+        # call before writeItem, which releases the object data
+        if 'obj' in item and 'rootobj' in item:
+            self.objects.append({"name": item['obj'], "type": item['properties']['type'], "size": len(item['rootobj'])/2})
+
+    def isEmpty(self):
+        return not self.objects
+
+    def write(self, filename):
+        """Writes the sidecar of the closed file filename."""
+        stat = os.stat(filename)
+        entry = {
+            "file": os.path.basename(filename),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "sha1": fileChecksum(filename),
+            "empty": self.isEmpty(),
+            "objects": self.objects,
+        }
+        atomicFile.writeAtomic(sidecarName(filename), lambda f: json.dump(entry, f, indent=0, sort_keys=True))
+        return entry
+
+def lookup(filename):
+    """
+    Returns the index entry of filename, or None if there is none or the
+    file changed since the entry was written.
+    """
+    try:
+        with open(sidecarName(filename)) as f:
+            entry = json.load(f)
+        stat = os.stat(filename)
+    except (IOError, OSError, ValueError):
+        return None
+    if entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+        return None
+    return entry
+
+def objectNames(entry):
+    return set(o["name"] for o in entry["objects"])
+
+def isEmptyFile(entry):
+    """Whether the file is treated as empty, as readParameters does with ROOT."""
+    return entry["empty"] or entry["size"] < minSize
+
+def isValid(entry):
+    return len(entry["objects"]) == nParameters
+
+def remove(filename):
+    if os.path.exists(sidecarName(filename)): os.remove(sidecarName(filename))
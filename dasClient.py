@@ -0,0 +1,107 @@
+#!/usr/bin/env python2
+# Bulk run information from DAS. Instead of one das_client call per run and
+# quantity, whole run ranges are queried at once and all quantities are
+# parsed from the json output in one pass.
+# The executable can be replaced (e.g. by a local stub) via $DAS_CLIENT.
+
+import os
+import json
+
+import runDB
+import instrument
+import externalCommands
+
+dasCommand = os.getenv("DAS_CLIENT", "das_client")
+maxRunSpan = 2000 # run numbers per query
+invalid = "\n" # marker used by getTime/getField for runs unknown to DAS
+
+# das field name: runDB field name
+runFields = {
+    "start_time": "start_time",
+    "end_time": "end_time",
+    "bfield": "bfield",
+}
+
+def query(q):
+    out = externalCommands.checkOutput([dasCommand, "--limit", "0", "--format", "json", "--query", q])
+    return json.loads(out)
+
+def parseRunInfos(result):
+    """Returns {run: {field: value}} from the json output of a run query."""
+    infos = {}
+    for record in result.get("data", []):
+        entries = record.get("run", [])
+        if isinstance(entries, dict): entries = [entries]
+        for entry in entries:
+            run = entry.get("run_number")
+            if run is None: continue
+            info = infos.setdefault(int(run), {})
+            for dasField, field in runFields.iteritems():
+                if entry.get(dasField) is not None:
+                    info[field] = str(entry[dasField]).strip()
+    return infos
+
+def runRanges(runs, maxSpan=maxRunSpan):
+    """Splits sorted run numbers into (first, last) ranges spanning at most maxSpan runs."""
+    ranges = []
+    for run in sorted(runs):
+        if ranges and run - ranges[-1][0] < maxSpan:
+            ranges[-1][1] = run
+        else:
+            ranges.append([run, run])
+    return [tuple(r) for r in ranges]
+
+def fetchRunInfos(firstRun, lastRun):
+    q = "run between [{},{}] | grep run.run_number, run.start_time, run.end_time, run.bfield".format(firstRun, lastRun)
+    return parseRunInfos(query(q))
+
+def prefetchRunInfos(runs, fields=["end_time", "bfield"], db=None, retryInvalid=False):
+    """
+    Fetches start/end time and B-field for all runs of which one of fields is
+    not yet known and stores them in the run database. Requested runs which
+    DAS does not know are marked as invalid and only queried again if
+    retryInvalid is set. Returns the number of queries.
+    """
+    if db is None: db = runDB.getDB()
+    isMissing = lambda v: v is None or (retryInvalid and v == invalid)
+    missing = [r for r in runs if any(isMissing(db.get(r, f)) for f in fields)]
+    instrument.count("run info cache hits", len(runs) - len(missing))
+    instrument.count("run info cache misses", len(missing))
+    nQueries = 0
+    for firstRun, lastRun in runRanges(missing):
+        infos = fetchRunInfos(firstRun, lastRun)
+        nQueries += 1
+        for run, info in infos.iteritems():
+            for field, value in info.iteritems():
+                db.set(run, field, value)
+    for run in missing:
+        for field in fields:
+            if isMissing(db.get(run, field)):
+                db.set(run, field, invalid)
+    return nQueries
+
+def getRunInfo(run, field, db=None, retryInvalid=False):
+    if db is None: db = runDB.getDB()
+    prefetchRunInfos([run], [field], db, retryInvalid)
+    return db.get(run, field)
+
+def getValidRunBefore(run, window=50, db=None):
+    """
+    Largest run below run with a known end time. Cached end times are used
+    first, DAS is only asked for the uncached runs of a block of window runs
+    when the runs above them are all invalid.
+    """
+    if db is None: db = runDB.getDB()
+    lastRun = run - 1
+    while lastRun > 0:
+        firstRun = max(1, lastRun - window + 1)
+        for r in range(lastRun, firstRun-1, -1):
+            value = db.get(r, "end_time")
+            if value is None:
+                # query the rest of the block at once
+                prefetchRunInfos(range(firstRun, r+1), ["end_time"], db)
+                value = db.get(r, "end_time")
+            if value != invalid:
+                return r
+        lastRun = firstRun - 1
+    return 0
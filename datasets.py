@@ -0,0 +1,37 @@
+#!/usr/bin/env python2
+# Registry of the datasets from which the PCL alignment results are
+# downloaded, with the output folder of each, so that all eras can be
+# processed in one call. The download state of the runs is in runState.py.
+
+import collections
+
+# storeName: parameter store which is filled while downloading
+Dataset = collections.namedtuple("Dataset", ["name", "dataset", "path", "outputFolder", "storeName"])
+
+alcaPath = "/AlCaReco/SiPixelAli"
+
+def expressDataset(era, version, stream="StreamExpress"):
+    return "/{}/{}-PromptCalibProdSiPixelAli-Express-v{}/ALCAPROMPT".format(stream, era, version)
+
+registry = collections.OrderedDict((d.name, d) for d in [
+    Dataset("Run2016B", expressDataset("Run2016B", 2), alcaPath, "root-files", "paramStore.npz"),
+    Dataset("Run2016C", expressDataset("Run2016C", 2), alcaPath, "root-files", "paramStore.npz"),
+    Dataset("Run2016D", expressDataset("Run2016D", 2), alcaPath, "root-files", "paramStore.npz"),
+    Dataset("Run2016E", expressDataset("Run2016E", 2), alcaPath, "root-files", "paramStore.npz"),
+    Dataset("Run2016F", expressDataset("Run2016F", 1), alcaPath, "root-files", "paramStore.npz"),
+    Dataset("Run2016G", expressDataset("Run2016G", 1), alcaPath, "root-files", "paramStore.npz"),
+    # proton-lead runs are kept apart from the proton-proton time evolution
+    Dataset("PARun2016B", expressDataset("PARun2016B", 1, "StreamExpressPA"), alcaPath, "root-files-PA", "paramStorePA.npz"),
+    Dataset("PARun2016C", expressDataset("PARun2016C", 1, "StreamExpressPA"), alcaPath, "root-files-PA", "paramStorePA.npz"),
+    Dataset("PARun2016D", expressDataset("PARun2016D", 1, "StreamExpressPA"), alcaPath, "root-files-PA", "paramStorePA.npz"),
+])
+
+defaultDatasets = ["Run2016B"]
+
+def getDatasets(names):
+    """names: list of registry names, "all" selects every dataset."""
+    if "all" in names: return registry.values()
+    unknown = [n for n in names if n not in registry]
+    if unknown:
+        raise KeyError("Unknown datasets {}, known are {}".format(", ".join(unknown), ", ".join(registry)))
+    return [registry[n] for n in names]
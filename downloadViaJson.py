@@ -8,14 +8,32 @@ import httplib
 import json
 import glob
 import re
+import ast
 import subprocess
+import urlparse
+import threading
+import Queue
+import socket
+import time
+import binascii
+import collections
 
-from ROOT import *
+import externalCommands
+import datasets
+import runState
+import contentIndex
+import paramStore
+import dasClient
+import prefetch
+
+from lazyROOT import ROOT
 from array import *
 
 serverurl = 'https://cmsweb.cern.ch/dqm/offline'
 ident = "DQMToJson/1.0 python/%d.%d.%d" % sys.version_info[:3]
 HTTPS = httplib.HTTPSConnection
+saveInterval = 30. # seconds between saving run states and parameter stores while downloading
+socketTimeout = 300. # seconds a connection may stall before the fetch fails and is retried
 
 def getGridCertificat():
     # Reads in PW from text file ~/.globus/.pw, which you have to create yourself
@@ -23,8 +41,6 @@ def getGridCertificat():
     proxyName = out.split("\n")[4][17:-1]
     return proxyName
 
-proxyName = getGridCertificat()
-
 class X509CertAuth(HTTPS):
     ssl_key_file = None
     ssl_cert_file = None
@@ -44,7 +60,7 @@ def x509_params():
 
     x509_path = os.getenv("X509_USER_PROXY", None)
     if not x509_path:
-        x509_path = proxyName
+        x509_path = getGridCertificat()
         os.environ["X509_USER_PROXY"] = x509_path
     if x509_path and os.path.exists(x509_path):
         key_file = cert_file = x509_path
@@ -79,68 +95,415 @@ def x509_params():
 
     return key_file, cert_file
 
-def dqm_get_json(server, run, dataset, path):
-    X509CertAuth.ssl_key_file, X509CertAuth.ssl_cert_file = x509_params()
-    datareq = urllib2.Request('%s/data/json/archive/%s%s/%s?rootcontent=1'
-                % (server, run, dataset, path))
-    datareq.add_header('User-agent', ident)
-    # return json.load(urllib2.build_opener(X509CertOpen()).open(datareq))
-    return eval(urllib2.build_opener(X509CertOpen()).open(datareq).read(),
-            { "__builtins__": None }, {})
-
-def saveAsFile(data, run, path="./"):
-    f = TFile(os.path.join(path,"Run{}.root".format(run)),"recreate")
-    for item in data['contents']:
-        if 'obj' in item.keys() and 'rootobj' in item.keys():
-            a = array('B')
-            a.fromstring(item['rootobj'].decode('hex'))
-            t = TBufferFile(TBufferFile.kRead, len(a), a, kFALSE)
-            rootType = item['properties']['type']
-            if rootType == 'TPROF':
-                rootType = 'TProfile'
-            h = t.ReadObject(eval(rootType+'.Class()'))
-            h.Write(item['obj'])
+_x509 = []
+
+def cachedX509Params():
+    # the certificate does not change during a job, resolve it only once
+    if not _x509:
+        _x509.append(x509_params())
+    return _x509[0]
+
+class DQMConnection:
+    """
+    Persistent connection to the DQM GUI, which is reused for all requests of
+    one worker. Plain http servers (e.g. a local stand-in) need no certificate.
+    """
+    def __init__(self, server):
+        url = urlparse.urlparse(server)
+        self.scheme = url.scheme
+        self.host = url.netloc
+        self.basePath = url.path
+        self.conn = None
+
+    def connect(self):
+        if self.scheme == "https":
+            keyFile, certFile = cachedX509Params()
+            self.conn = httplib.HTTPSConnection(self.host, key_file=keyFile, cert_file=certFile, timeout=socketTimeout)
+        else:
+            self.conn = httplib.HTTPConnection(self.host, timeout=socketTimeout)
+
+    def open(self, path):
+        """Sends the request and returns the response, which has to be read completely."""
+        if not self.conn: self.connect()
+        try:
+            self.conn.request("GET", self.basePath + path, headers={"User-agent": ident})
+            response = self.conn.getresponse()
+        except socket.timeout:
+            raise
+        except (httplib.HTTPException, IOError):
+            # server closed the kept-alive connection, try once with a new one
+            self.close()
+            self.connect()
+            self.conn.request("GET", self.basePath + path, headers={"User-agent": ident})
+            response = self.conn.getresponse()
+        if response.status != 200:
+            response.read()
+            raise IOError("HTTP {} for {}".format(response.status, path))
+        return response
+
+    def close(self):
+        if self.conn: self.conn.close()
+        self.conn = None
+
+def dqmJsonPath(run, dataset, path):
+    return '/data/json/archive/%s%s/%s?rootcontent=1' % (run, dataset, path)
+
+# string literals in both quote styles, and the brackets outside of them
+_literalTokens = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|[][{}]', re.S)
+_contentsKey = re.compile(r'["\']contents["\']')
+# names the DQM GUI writes which are no json, e.g. nan for empty statistics
+_literalNames = {"nan": float("nan"), "inf": float("inf"), "true": True, "false": False, "null": None}
+
+def entryEnd(buf):
+    """End of the object or list at the start of buf, None if it is not complete yet."""
+    depth = 0
+    for m in _literalTokens.finditer(buf):
+        token = m.group()
+        if token in "[{": depth += 1
+        elif token in "]}":
+            depth -= 1
+            if depth == 0: return m.end()
+    return None
+
+def literalValue(node):
+    """
+    Value of a parsed python literal. Only strings, numbers, lists, tuples,
+    dicts and the names in _literalNames are accepted, nothing is evaluated.
+    """
+    if isinstance(node, ast.Expression):
+        return literalValue(node.body)
+    if isinstance(node, ast.Str):
+        return node.s
+    if isinstance(node, ast.Num):
+        return node.n
+    if isinstance(node, ast.List):
+        return [literalValue(x) for x in node.elts]
+    if isinstance(node, ast.Tuple):
+        return tuple(literalValue(x) for x in node.elts)
+    if isinstance(node, ast.Dict):
+        return dict((literalValue(k), literalValue(v)) for k, v in zip(node.keys, node.values))
+    if isinstance(node, ast.Name) and node.id in _literalNames:
+        return _literalNames[node.id]
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        value = literalValue(node.operand)
+        if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+            return -value if isinstance(node.op, ast.USub) else value
+    raise ValueError("No literal in DQM json entry: {}".format(type(node).__name__))
+
+def parseEntry(text):
+    """
+    Parses one entry of the contents list. The DQM GUI output is not always
+    strict json, such entries are read as python literals with literalValue.
+    None if text is incomplete, ValueError if it is no literal.
+    """
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    try:
+        tree = ast.parse(text, mode="eval")
+    except SyntaxError:
+        return None
+    try:
+        return literalValue(tree)
+    except TypeError as e: # e.g. a list as dict key
+        raise ValueError("Invalid DQM json entry: {}".format(e))
+
+def iterDqmContents(stream, chunkSize=1<<16):
+    """
+    Yields the entries of the 'contents' list of a DQM json payload one by
+    one while reading the stream, so only one entry is held in memory.
+    Entries are decoded as json, entries which are no strict json with
+    parseEntry.
+    """
+    decoder = json.JSONDecoder()
+    keyLength = len('"contents"')
+    buf = ""
+    while True: # skip everything up to the contents list
+        m = _contentsKey.search(buf)
+        if m:
+            buf = buf[m.end():]
+            break
+        chunk = stream.read(chunkSize)
+        if not chunk: return
+        buf = buf[-keyLength:] + chunk
+    readSize = chunkSize
+    while True:
+        buf = buf.lstrip(" \t\r\n:[,")
+        if buf.startswith("]"):
+            return
+        try:
+            item, end = decoder.raw_decode(buf)
+        except ValueError:
+            end = entryEnd(buf)
+            item = parseEntry(buf[:end]) if end else None
+            if item is None:
+                # entry not complete yet, read at least as much as buffered to stay linear
+                chunk = stream.read(max(readSize, len(buf)))
+                if not chunk: raise ValueError("Truncated or invalid DQM json payload")
+                buf += chunk
+                continue
+        buf = buf[end:]
+        yield item
+
+def dqm_get_json(server, run, dataset, path, connection=None):
+    conn = connection or DQMConnection(server)
+    response = conn.open(dqmJsonPath(run, dataset, path))
+    data = {'contents': list(iterDqmContents(response))}
+    response.read()
+    if not connection: conn.close()
+    return data
+
+class ObjectBuffer:
+    """Byte buffer reused for deserialising the objects of a payload one after another."""
+    def __init__(self):
+        self.a = array('B')
+
+    def fill(self, hexString):
+        del self.a[:]
+        self.a.fromstring(binascii.unhexlify(hexString))
+        return self.a
+
+def writeItem(item, objBuffer):
+    # writes one entry of the contents list into the current directory and returns the object
+    if 'obj' in item.keys() and 'rootobj' in item.keys():
+        a = objBuffer.fill(item['rootobj'])
+        item['rootobj'] = None
+        t = ROOT.TBufferFile(ROOT.TBufferFile.kRead, len(a), a, ROOT.kFALSE)
+        rootType = item['properties']['type']
+        if rootType == 'TPROF':
+            rootType = 'TProfile'
+        h = t.ReadObject(ROOT.TClass.GetClass(rootType))
+        if not h: raise ValueError("Could not read {} of type {}".format(item['obj'], rootType))
+        h.Write(item['obj'])
+        return h
+
+class ParameterCollector:
+    """
+    Bin contents and errors of the parameter histograms of one run, taken
+    from the objects while they are written, for the parameter store.
+    """
+    def __init__(self):
+        self.row = paramStore.emptyRow()
+        self.found = False
+
+    def add(self, name, h):
+        if h and name in paramStore.parameterNames:
+            paramStore.fillFromHist(self.row, paramStore.parameterNames.index(name), h)
+            self.found = True
+
+    def store(self, store, run, filename):
+        # after the file is closed, so the entry is current for the size and
+        # modification time of the file on disk and it is not read again
+        stat = os.stat(filename)
+        empty = not self.found or stat.st_size < contentIndex.minSize # as readParameters
+        content, error, nbins = paramStore.emptyRow() if empty else self.row
+        store.set(run, content, error, nbins, stat.st_mtime, stat.st_size)
+
+def rootFileName(run, path="./"):
+    return os.path.join(path,"Run{}.root".format(run))
+
+def saveAsFile(data, run, path="./", store=None):
+    # data is either the json dictionary or an iterable over its contents,
+    # the parameters are added to store if given
+    f = ROOT.TFile(rootFileName(run, path),"recreate")
+    objBuffer = ObjectBuffer()
+    recorder = contentIndex.ContentRecorder()
+    collector = ParameterCollector()
+    for item in data['contents'] if isinstance(data, dict) else data:
+        f.cd()
+        recorder.add(item)
+        collector.add(item.get('obj'), writeItem(item, objBuffer))
     f.Close()
+    entry = recorder.write(rootFileName(run, path))
+    if store is not None: collector.store(store, run, rootFileName(run, path))
+    return entry
 
 def getRuns(dataset):
-    out = subprocess.check_output(["das_client --limit 0 --query='run dataset={}'".format(dataset)], shell=True)
+    out = externalCommands.checkOutput([dasClient.dasCommand, "--limit", "0", "--query", "run dataset={}".format(dataset)])
     return sorted([int(r) for r in out.split("\n") if r])
 
-def getLastRun(path="./"):
-    maxRun = -1
+def existingRuns(path):
+    runs = set()
     for f in glob.glob(os.path.join(path,"Run*.root")):
         m = re.match(".*Run(\d+).root", f)
-        if m:
-            run = int(m.group(1))
-            if run > maxRun:
-                maxRun = run
-    return maxRun
-
-def downloadViaJson():
-    # downloads files and returns their run numbers
-    dataset = "/StreamExpress/Run2016B-PromptCalibProdSiPixelAli-Express-v2/ALCAPROMPT"
-    #dataset = "/StreamExpress/Run2016C-PromptCalibProdSiPixelAli-Express-v2/ALCAPROMPT"
-    #dataset = "/StreamExpress/Run2016D-PromptCalibProdSiPixelAli-Express-v2/ALCAPROMPT"    
-    #dataset = "/StreamExpress/Run2016E-PromptCalibProdSiPixelAli-Express-v2/ALCAPROMPT"    
-    #dataset = "/StreamExpress/Run2016F-PromptCalibProdSiPixelAli-Express-v1/ALCAPROMPT"
-    #dataset = "/StreamExpress/Run2016G-PromptCalibProdSiPixelAli-Express-v1/ALCAPROMPT"    
-    #dataset = "/StreamExpressPA/PARun2016B-PromptCalibProdSiPixelAli-Express-v1/ALCAPROMPT"
-    #dataset = "/StreamExpressPA/PARun2016C-PromptCalibProdSiPixelAli-Express-v1/ALCAPROMPT"    
-    #dataset = "/StreamExpressPA/PARun2016D-PromptCalibProdSiPixelAli-Express-v1/ALCAPROMPT"
-    
-    path = "/AlCaReco/SiPixelAli"
-
-    outputFolder = "root-files"
-
-    runs = getRuns(dataset)
-    maxRun = getLastRun(outputFolder)
-    runs = [r for r in runs if r>maxRun]
-
-    for run in runs:
-        print "Get run", run
-        data = dqm_get_json(serverurl, str(run), dataset, path)
-        saveAsFile(data, run, outputFolder)
+        if m: runs.add(int(m.group(1)))
     return runs
 
+def getLastRun(path="./"):
+    return max(existingRuns(path) or [-1])
+
+# one run to download: (run, dataset, path, outputFolder)
+DownloadTask = collections.namedtuple("DownloadTask", ["run", "dataset", "path", "outputFolder"])
+
+def fetchWorker(server, taskQueue, resultQueue, maxRetries, retryDelay):
+    # streams the entries of each run into resultQueue, framed by start and done/fail
+    conn = DQMConnection(server)
+    while True:
+        task = taskQueue.get()
+        if task is None: break
+        for attempt in range(maxRetries+1):
+            try:
+                resultQueue.put((task, "start", None))
+                response = conn.open(dqmJsonPath(str(task.run), task.dataset, task.path))
+                for item in iterDqmContents(response):
+                    resultQueue.put((task, "item", item))
+                response.read()
+                resultQueue.put((task, "done", None))
+                break
+            except Exception as e:
+                conn.close()
+                if attempt == maxRetries:
+                    resultQueue.put((task, "fail", e))
+                else:
+                    time.sleep(retryDelay * 2**attempt)
+    conn.close()
+
+def downloadTasks(tasks, server=serverurl, jobs=4, maxRetries=3, retryDelay=5., onFinished=None, stores={}):
+    """
+    Downloads the runs of tasks, possibly of several datasets, with jobs
+    parallel connections. Writing the ROOT files is done in the calling thread
+    (ROOT is not thread safe) while the workers continue fetching. The
+    parameters of runs in an output folder of stores ({outputFolder:
+    parameter store}) are added to that store from the written objects.
+    Returns {task: state} with the states of runState.py, onFinished(task,
+    state) is called as soon as a task is finished.
+    """
+    if server.startswith("https"):
+        cachedX509Params() # exits if there is no certificate, do this before starting threads
+    taskQueue = Queue.Queue()
+    resultQueue = Queue.Queue(maxsize=4*jobs) # bounds the number of entries held in memory
+    for task in tasks: taskQueue.put(task)
+    workers = []
+    for i in range(min(jobs, len(tasks))):
+        taskQueue.put(None)
+        w = threading.Thread(target=fetchWorker, args=(server, taskQueue, resultQueue, maxRetries, retryDelay))
+        w.daemon = True
+        w.start()
+        workers.append(w)
+    states = {}
+    openFiles = {}
+    recorders = {}
+    collectors = {}
+    writeErrors = {} # tasks with an entry which could not be written, their further entries are skipped
+    objBuffer = ObjectBuffer()
+    while len(states) < len(tasks):
+        try:
+            task, kind, payload = resultQueue.get(timeout=10.)
+        except Queue.Empty:
+            if any(w.is_alive() for w in workers): continue
+            raise RuntimeError("Download workers stopped without finishing all runs")
+        if kind == "start": # also after a failed attempt, start from scratch
+            if task in openFiles: openFiles[task].Close()
+            openFiles[task] = ROOT.TFile(rootFileName(task.run, task.outputFolder), "recreate")
+            recorders[task] = contentIndex.ContentRecorder()
+            collectors[task] = ParameterCollector()
+            writeErrors.pop(task, None)
+        elif kind == "item":
+            if task in writeErrors: continue
+            try:
+                openFiles[task].cd()
+                recorders[task].add(payload)
+                collectors[task].add(payload.get('obj'), writeItem(payload, objBuffer))
+            except Exception as e:
+                writeErrors[task] = e
+        elif kind == "done" and task not in writeErrors:
+            openFiles.pop(task).Close()
+            entry = recorders.pop(task).write(rootFileName(task.run, task.outputFolder))
+            collector = collectors.pop(task)
+            if task.outputFolder in stores:
+                collector.store(stores[task.outputFolder], task.run, rootFileName(task.run, task.outputFolder))
+            print "Get run", task.run
+            states[task] = runState.empty if entry["empty"] else runState.downloaded
+        else: # fetching failed, or an entry could not be written
+            openFiles.pop(task).Close()
+            recorders.pop(task)
+            collectors.pop(task)
+            os.remove(rootFileName(task.run, task.outputFolder))
+            contentIndex.remove(rootFileName(task.run, task.outputFolder))
+            print "Could not get run", task.run, ":", writeErrors.pop(task, payload)
+            states[task] = runState.failed
+        if kind in ["done", "fail"] and onFinished: onFinished(task, states[task])
+    for w in workers: w.join()
+    return states
+
+def downloadRuns(runs, dataset, path, outputFolder, server=serverurl, jobs=4, maxRetries=3, retryDelay=5.):
+    """Downloads runs of one dataset, returns the runs which have been saved."""
+    tasks = [DownloadTask(run, dataset, path, outputFolder) for run in runs]
+    states = downloadTasks(tasks, server, jobs, maxRetries, retryDelay)
+    return sorted(task.run for task, state in states.iteritems() if state != runState.failed)
+
+def downloadDatasets(dsets, server=serverurl, jobs=4, states=None, retryDelay=3600., maxAttempts=8, retryEmpty=False, emptyDelay=3*3600., maxEmptyAttempts=6):
+    """
+    Downloads the missing runs of several datasets (entries of the dataset
+    registry) at once: runs DAS knows which were not downloaded yet, and
+    failed or empty runs whose retry delay (doubled after each attempt, see
+    runState.toFetch) has passed.
+    The run lists are queried concurrently, and all runs share one pool of
+    connections. Run metadata of the new runs is fetched into the run
+    database meanwhile, and their parameters are added to the parameter
+    store of the dataset. Returns {dataset name: saved runs}.
+    """
+    if states is None: states = runState.RunStateIndex()
+    storesByName = dict((d.storeName, paramStore.ParameterStore(d.storeName)) for d in dsets)
+    stores = dict((d.outputFolder, storesByName[d.storeName]) for d in dsets)
+    lookups = prefetch.Prefetcher(max(1, len(dsets)))
+    for d in dsets:
+        lookups.submit(d.name, getRuns, d.dataset)
+    tasks = []
+    names = {}
+    for d in dsets:
+        runs = lookups.get(d.name)
+        if runs is None: continue # DAS failed, try again next time
+        if not os.path.isdir(d.outputFolder): os.makedirs(d.outputFolder)
+        if not states.isKnown(d.name):
+            # first call for this dataset, take over the files already present
+            for run in existingRuns(d.outputFolder).intersection(runs):
+                states.set(d.name, run, runState.downloaded)
+        states.addRuns(d.name, runs)
+        tasks += [DownloadTask(r, d.dataset, d.path, d.outputFolder) for r in states.toFetch(d.name, retryDelay, maxAttempts, retryEmpty, emptyDelay, maxEmptyAttempts)]
+        names[d.dataset] = d.name
+    lookups.submit("runInfos", dasClient.prefetchRunInfos, sorted(set(t.run for t in tasks)))
+    def save():
+        # watch.py and makePlots.py read the stores meanwhile, save() merges their changes
+        states.save()
+        for store in storesByName.values(): store.save()
+        lastSave[0] = time.time()
+    lastSave = [time.time()]
+    def onFinished(task, state):
+        states.set(names[task.dataset], task.run, state)
+        if time.time() - lastSave[0] > saveInterval: save()
+    try:
+        results = downloadTasks(tasks, server, jobs, onFinished=onFinished, stores=stores)
+    finally:
+        save()
+    lookups.get("runInfos")
+    lookups.close()
+    savedRuns = dict((d.name, []) for d in dsets)
+    for task, state in results.iteritems():
+        if state != runState.failed: savedRuns[names[task.dataset]].append(task.run)
+    for name, runs in savedRuns.iteritems():
+        runs.sort()
+        failedRuns = states.runs(name, runState.failed)
+        if failedRuns: print "{}: {} runs failed so far, e.g. {}".format(name, len(failedRuns), failedRuns[:5])
+    return savedRuns
+
+def downloadViaJson(jobs=4, names=datasets.defaultDatasets, retryEmpty=False):
+    # downloads files of the datasets names (see datasets.py) and returns their run numbers
+    savedRuns = downloadDatasets(datasets.getDatasets(names), jobs=jobs, retryEmpty=retryEmpty)
+    return sorted(sum(savedRuns.values(), []))
+
 if __name__ == "__main__":
-    downloadViaJson()
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", "-j", type=int, default=4, help="Number of parallel downloads")
+    parser.add_argument("--datasets", default=",".join(datasets.defaultDatasets), help="Comma separated names from datasets.py, or all")
+    parser.add_argument("--list", action="store_true", help="List the known datasets")
+    parser.add_argument("--retry-empty", action="store_true", help="Download runs which were empty before right away, not only after their retry delay")
+    parser.add_argument("--timeout", type=float, default=socketTimeout, help="Seconds a connection may stall before the run is tried again")
+    args = parser.parse_args()
+    socketTimeout = args.timeout
+    if args.list:
+        for d in datasets.registry.values(): print d.name, d.dataset, d.outputFolder
+        sys.exit(0)
+    downloadViaJson(args.jobs, args.datasets.split(","), args.retry_empty)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python2
+# Running the external tools (das_client, brilcalc, conddb) with a timeout,
+# so that one hanging call cannot stall the whole job.
+
+import os
+import time
+import threading
+import subprocess
+
+import instrument
+
+defaultTimeout = 600 # seconds
+
+class CommandTimeout(Exception):
+    pass
+
+def checkOutput(cmd, timeout=None, shell=False):
+    """
+    Like subprocess.check_output, but the process is killed after timeout
+    seconds, by default after defaultTimeout (which may be changed at runtime).
+    """
+    if timeout is None: timeout = defaultTimeout
+    start = time.time()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=shell)
+    killed = []
+    def kill():
+        killed.append(True)
+        proc.kill()
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        out, _ = proc.communicate()
+    finally:
+        timer.cancel()
+        tool = os.path.basename((cmd if isinstance(cmd, basestring) else cmd[0]).split()[0])
+        instrument.addTime("subprocess " + tool, time.time() - start)
+    if killed:
+        instrument.count("subprocess timeouts")
+        raise CommandTimeout("{} did not finish within {}s".format(cmd, timeout))
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, out)
+    return out
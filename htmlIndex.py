@@ -0,0 +1,140 @@
+#!/usr/bin/env python2
+# Run table of the web page. The rows are cached per run, so only the rows of
+# new or changed runs are computed. The landing page shows only the latest
+# runs, the history is split into one archive page per block of run numbers
+# and a page is only written again if its rows changed.
+
+import os
+import json
+import string
+import hashlib
+
+import atomicFile
+
+defaultRowCacheName = "indexRows.json"
+runsPerPage = 1000 # run number range of one archive page
+latestRuns = 50 # rows on the landing page
+
+class RowCache:
+    """
+    {run: row} where row is a dictionary with the input hash, whether the run
+    has results, the end time and the cut status. Also remembers the content
+    hash of every written page.
+    """
+    def __init__(self, filename=defaultRowCacheName):
+        self.filename = filename
+        self.rows = {}
+        self.pages = {}
+        self.changed = False
+        if filename and os.path.exists(filename):
+            with open(filename) as f:
+                data = json.load(f)
+            self.rows = dict((int(run), row) for run, row in data["rows"].iteritems())
+            self.pages = data["pages"]
+
+    def get(self, run, inputHash):
+        row = self.rows.get(run)
+        return row if row and row["input"] == inputHash else None
+
+    def set(self, run, inputHash, row):
+        row["input"] = inputHash
+        self.rows[run] = row
+        self.changed = True
+
+    def keepOnly(self, runs):
+        runs = set(runs)
+        for run in [r for r in self.rows if r not in runs]:
+            del self.rows[run]
+            self.changed = True
+
+    def save(self):
+        if not self.changed: return
+        atomicFile.writeAtomic(self.filename, lambda f: json.dump({"rows": self.rows, "pages": self.pages}, f, indent=0, sort_keys=True))
+        self.changed = False
+
+def updateRows(cache, records, rowHash, makeRow):
+    """
+    Returns the rows of records in their order. makeRow(record) is only called
+    for runs whose rowHash(record) differs from the cached one.
+    """
+    rows = []
+    for record in records:
+        h = rowHash(record)
+        row = cache.get(record.run, h)
+        if row is None:
+            row = makeRow(record)
+            cache.set(record.run, h, row)
+        rows.append((record.run, row))
+    cache.keepOnly(run for run, row in rows)
+    return rows
+
+def rowString(run, row, withImage=False, plotPrefix="plots/", withStatus=True):
+    link = "No results"
+    if row["filled"]:
+        if withImage:
+            link = "<a href={0}Run{1}.pdf><img src='{0}Run{1}.png' border='0'/></a>".format(plotPrefix, run)
+        else:
+            link = "<a href={0}Run{1}.pdf>pdf</a>".format(plotPrefix, run)
+    status = " <td>{}</td>".format(row.get("status", "")) if withStatus else ""
+    return "<tr> <td>{0}</td> <td>{1}</td> <td>{2}</td>{3} </tr>".format(run, row["endTime"], link, status)
+
+def tableString(rows, maxPlots=5, withStatus=True):
+    """rows: [(run, row)] ordered from the newest to the oldest run."""
+    lines = ["<table>", "<tr> <td> Run </td> <td> End time </td> <td>Parameters</td>{} </tr>".format(" <td> Status </td>" if withStatus else "")]
+    for run, row in rows:
+        withImage = row["filled"] and maxPlots > 0
+        if withImage: maxPlots -= 1
+        lines.append(rowString(run, row, withImage, withStatus=withStatus))
+    lines.append("</table>")
+    return "\n".join(lines)
+
+def pageName(block):
+    return "runs_{}-{}.html".format(block*runsPerPage, (block+1)*runsPerPage-1)
+
+pageTemplate = """<!DOCTYPE html>
+<html>
+  <head>
+    <title>Runs ${first} to ${last}</title>
+  </head>
+  <body>
+  <p><a href=index.html>Back to the latest runs</a></p>
+  ${table}
+  </body>
+</html>
+"""
+
+def writeIfChanged(cache, dest, content):
+    """Writes content to dest unless the same content was written before."""
+    h = hashlib.sha1(content).hexdigest()
+    key = os.path.basename(dest)
+    if cache.pages.get(key) == h and os.path.exists(dest):
+        return False
+    atomicFile.writeAtomic(dest, lambda f: f.write(content))
+    cache.pages[key] = h
+    cache.changed = True
+    return True
+
+def writeIndex(rows, cache, source, destDir, changes={}, maxPlots=5, withStatus=True):
+    """
+    Writes destDir/index.html from the template source with the latest rows
+    as ${table} and links to the archive pages as ${archive}, and one archive
+    page per block of runsPerPage run numbers. rows are ordered from the
+    newest to the oldest run. Returns the names of the written pages.
+    """
+    blocks = {}
+    for run, row in rows:
+        blocks.setdefault(run // runsPerPage, []).append((run, row))
+    written = []
+    for block, blockRows in blocks.iteritems():
+        content = string.Template(pageTemplate).substitute(
+            first=block*runsPerPage, last=(block+1)*runsPerPage-1,
+            table=tableString(blockRows, 0, withStatus))
+        if writeIfChanged(cache, os.path.join(destDir, pageName(block)), content):
+            written.append(pageName(block))
+    archive = " ".join("<a href={}>{}</a>".format(pageName(b), b*runsPerPage) for b in sorted(blocks, reverse=True))
+    with open(source) as f:
+        template = string.Template(f.read())
+    changes = dict(changes, table=tableString(rows[:latestRuns], maxPlots, withStatus), archive=archive)
+    if writeIfChanged(cache, os.path.join(destDir, "index.html"), template.safe_substitute(changes)):
+        written.append("index.html")
+    return written
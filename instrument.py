@@ -0,0 +1,64 @@
+#!/usr/bin/env python2
+# Timers and counters for the stages of the nightly job. Everything is a
+# no-op until enable() is called, so the calls can stay in the code.
+
+import json
+import time
+import threading
+import collections
+
+class State:
+    enabled = False
+    start = None
+    timers = collections.defaultdict(float)
+    calls = collections.defaultdict(int)
+    counters = collections.defaultdict(int)
+    lock = threading.Lock() # metadata lookups run in threads
+
+def enable():
+    State.enabled = True
+    State.start = time.time()
+
+def count(name, n=1):
+    if not State.enabled: return
+    with State.lock:
+        State.counters[name] += n
+
+def addTime(name, seconds):
+    if not State.enabled: return
+    with State.lock:
+        State.timers[name] += seconds
+        State.calls[name] += 1
+
+class _Stage(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *_):
+        addTime(self.name, time.time() - self.start)
+
+class _NoStage(object):
+    def __enter__(self): pass
+    def __exit__(self, *_): pass
+
+_noStage = _NoStage()
+
+def stage(name):
+    """Context manager adding the time spent inside to the timer name."""
+    return _Stage(name) if State.enabled else _noStage
+
+def report():
+    with State.lock:
+        return {
+            "start": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(State.start)) if State.start else None,
+            "total": time.time() - State.start if State.start else None,
+            "timers": dict((name, {"seconds": t, "calls": State.calls[name]}) for name, t in State.timers.iteritems()),
+            "counters": dict(State.counters),
+        }
+
+def writeReport(filename):
+    with open(filename, "w") as f:
+        json.dump(report(), f, indent=2, sort_keys=True)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python2
+# Cache of the IOVs (first run of every payload) of conddb tags. conddb is
+# asked at most once per ttl seconds for each tag, and the times of the
+# update runs are kept as well, so the update lines of the summary plots
+# need no lookups for runs which were already known.
+
+import os
+import json
+import time
+import numpy
+import threading
+
+import atomicFile
+import externalCommands
+
+defaultCacheName = "iovCache.json"
+defaultTTL = 3600. # seconds
+
+def parseIOVs(output):
+    """Since run of every IOV in the output of conddb list, skipping the two header lines."""
+    return [int(x.split()[0]) for x in output.split("\n")[2:] if x]
+
+class IOVCache:
+    """
+    tags: {tag: {"runs": sorted since runs, "checked": time of the last
+    conddb call}}, times: {run: time in seconds} of the since runs.
+    """
+    def __init__(self, filename=defaultCacheName, ttl=defaultTTL):
+        self.filename = filename
+        self.ttl = ttl
+        self.tags = {}
+        self.times = {}
+        self.lock = threading.Lock() # several tags may be updated in parallel
+        if filename and os.path.exists(filename):
+            with open(filename) as f:
+                data = json.load(f)
+            self.tags = data["tags"]
+            self.times = dict((int(run), t) for run, t in data["times"].iteritems())
+
+    def runs(self, tag):
+        return self.tags[tag]["runs"] if tag in self.tags else []
+
+    def isExpired(self, tag, now=None):
+        if now is None: now = time.time()
+        return tag not in self.tags or now - self.tags[tag]["checked"] > self.ttl
+
+    def update(self, tag, force=False):
+        """
+        Asks conddb for the IOVs of tag if the cached ones are older than ttl.
+        conddb always lists all IOVs, only the new ones are added. Returns the
+        new since runs.
+        """
+        if not force and not self.isExpired(tag): return []
+        out = externalCommands.checkOutput(["conddb", "list", tag])
+        with self.lock:
+            entry = self.tags.setdefault(tag, {"runs": [], "checked": 0})
+            new = sorted(set(parseIOVs(out)).difference(entry["runs"]))
+            entry["runs"] = sorted(entry["runs"] + new)
+            entry["checked"] = time.time()
+        self.save()
+        return new
+
+    def arrays(self, tags, minRun=-1, timeOf=None):
+        """
+        Since runs >= minRun of all tags and, if timeOf(run) is given, their
+        times, as numpy arrays. Each time is computed only once.
+        """
+        runs = sorted(set(r for tag in tags for r in self.runs(tag) if r >= minRun))
+        if timeOf is None:
+            return numpy.array(runs, dtype=numpy.int64), None
+        missing = [run for run in runs if run not in self.times]
+        for run in missing:
+            t = timeOf(run)
+            with self.lock:
+                self.times[run] = t
+        if missing: self.save()
+        return numpy.array(runs, dtype=numpy.int64), numpy.array([self.times[run] for run in runs], dtype=float)
+
+    def cachedArrays(self, tags, minRun=-1):
+        """
+        Since runs >= minRun whose time is cached, and their times, without
+        any lookup. Safe while another thread updates the cache, e.g. as
+        fallback if that takes too long. Both arrays are empty without cache.
+        """
+        with self.lock:
+            runs = sorted(set(r for tag in tags for r in self.runs(tag) if r >= minRun and r in self.times))
+            times = [self.times[run] for run in runs]
+        return numpy.array(runs, dtype=numpy.int64), numpy.array(times, dtype=float)
+
+    def save(self):
+        with self.lock:
+            atomicFile.writeAtomic(self.filename, lambda f: json.dump({"tags": self.tags, "times": self.times}, f, indent=0, sort_keys=True))
+
+_caches = {}
+
+def getCache(filename=defaultCacheName):
+    if filename not in _caches:
+        _caches[filename] = IOVCache(filename)
+    return _caches[filename]
@@ -0,0 +1,24 @@
+#!/usr/bin/env python2
+# Importing ROOT (and setting up the plot style) takes seconds. The ROOT
+# object defined here loads both on the first attribute access, so code
+# paths which do not touch ROOT do not pay for it.
+
+import suppressor
+
+class LazyROOT(object):
+    _module = None
+
+    def load(self):
+        if LazyROOT._module is None:
+            with suppressor.suppress_stdout_stderr(): import ROOT
+            LazyROOT._module = ROOT
+            import style # sets the default style and batch mode
+        return LazyROOT._module
+
+    def isLoaded(self):
+        return LazyROOT._module is not None
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+ROOT = LazyROOT()
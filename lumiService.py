@@ -0,0 +1,68 @@
+#!/usr/bin/env python2
+# Recorded luminosity per run, cached in the run database. brilcalc is only
+# asked for the last few runs with known luminosity and newer ones, and at
+# most once per process. The executable can be replaced via $BRILCALC.
+
+import os
+
+import runDB
+import externalCommands
+
+brilcalcCommand = os.getenv("BRILCALC", "/afs/cern.ch/user/a/auterman/.local/bin/brilcalc")
+normtag = "/afs/cern.ch/user/l/lumipro/public/normtag_file/normtag_BRIL.json"
+
+recheckRuns = 3 # last cached runs which are queried again
+
+_updated = set()
+
+def parseLumiByRun(output):
+    """
+    Expects the csv output of brilcalc lumi, e.g.
+    #run:fill,time,nls,ncms,delivered(/fb),recorded(/fb)
+    273158:4915,05/12/16 08:47:41,57,57,0.004,0.003
+    and returns {run: recorded luminosity (/fb)}.
+    """
+    lumis = {}
+    for line in output.split("\n"):
+        if not line or line.startswith("#"): continue
+        cols = line.split(",")
+        lumis[int(cols[0].split(":")[0])] = float(cols[-1])
+    return lumis
+
+def queryLumi(minRun, maxRun=None):
+    cmd = [brilcalcCommand, "lumi", "-b", "STABLE BEAMS", "--normtag="+normtag, "-u", "/fb", "--output-style", "csv", "--begin", str(minRun)]
+    if maxRun is not None: cmd += ["--end", str(maxRun)]
+    return parseLumiByRun(externalCommands.checkOutput(cmd))
+
+def updateLumi(minRun, db=None):
+    """
+    Fetches the luminosity of the last recheckRuns cached runs and all runs
+    after them, and of the runs before the first cached run if minRun lies
+    before it. The last cached runs may have been queried while they were
+    still being certified, so their values are refreshed.
+    """
+    if db is None: db = runDB.getDB()
+    known = db.items("lumi")
+    ranges = [] # (first, last, mark first run as covered)
+    if known and minRun < min(known):
+        ranges.append((minRun, min(known)-1, True))
+    if db.dbName not in _updated:
+        ranges.append((sorted(known)[-recheckRuns:][0], None, False) if known else (minRun, None, True))
+        _updated.add(db.dbName)
+    for first, last, markFirst in ranges:
+        lumis = queryLumi(first, last)
+        # a run without stable beams has no luminosity; storing zero for the
+        # first queried run marks the range as covered for the next call
+        if markFirst: lumis.setdefault(first, 0.)
+        for run, lumi in lumis.iteritems():
+            db.set(run, "lumi", lumi)
+
+def expireHorizon():
+    """Lets the next call ask brilcalc for new runs again, for long running processes."""
+    _updated.clear()
+
+def integratedLumi(minRun, maxRun=None, db=None):
+    """Recorded luminosity (/fb) of all runs in [minRun, maxRun]."""
+    if db is None: db = runDB.getDB()
+    updateLumi(minRun, db)
+    return sum(l for run, l in db.items("lumi").iteritems() if run >= minRun and (maxRun is None or run <= maxRun))
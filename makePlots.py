@@ -1,7 +1,6 @@
 #!/usr/bin/env python2
 
 import collections
-import glob
 import re
 import os
 import copy
@@ -9,24 +8,31 @@ import numpy
 import datetime
 import string
 import shutil
-import subprocess
-import pickle
 import math
+import json
+import time
+import argparse
+import multiprocessing
+import atexit
+import cProfile
+
+import sys
+from lazyROOT import ROOT
+import paramStore
+import runDB
+import dasClient
+import renderManifest
+import lumiService
+import externalCommands
+import prefetch
+import htmlIndex
+import plotOutput
+import contentIndex
+import iovCache
+import instrument
 
-import suppressor
-with suppressor.suppress_stdout_stderr(): import ROOT
-import downloadViaJson
-import style
-
-#user specific stuff like workdirs
-##import userEnvironment.config 
-import imp
-
-from operator import itemgetter
 from array import array
 
-userEnvironment = imp.load_source('userEnvironment.config', '.')
-
 class Parameter:
     name = ""
     filename = ""
@@ -50,24 +56,29 @@ parameters = [
     Parameter("Zrot", "Zrot",    "#Delta#theta_{z} (#murad)", 30, -70, 100 ), \
     ]
 parDict = collections.OrderedDict( (p.name, p) for p in parameters )
+# values of ROOT's EColor, so that ROOT is not needed to define the objects
+kBlack, kRed, kGreen, kBlue, kMagenta, kCyan = 1, 632, 416, 600, 616, 432
 objects = [
-    ("FPIX(x+,z-)", ROOT.kBlack,   20),
-    ("BPIX(x+)",    ROOT.kBlue,    21),
-    ("FPIX(x+,z+)", ROOT.kGreen+2, 22),
-    ("FPIX(x-,z-)", ROOT.kRed,     24),
-    ("BPIX(x-)",    ROOT.kCyan,    25),
-    ("FPIX(x-,z+)", ROOT.kMagenta, 26),
+    ("FPIX(x+,z-)", kBlack,   20),
+    ("BPIX(x+)",    kBlue,    21),
+    ("FPIX(x+,z+)", kGreen+2, 22),
+    ("FPIX(x-,z-)", kRed,     24),
+    ("BPIX(x-)",    kCyan,    25),
+    ("FPIX(x-,z+)", kMagenta, 26),
 ]
 
 plotDir = "/afs/cern.ch/user/a/auterman/public/plots"
+renderVersion = 1 # increase when the plots change, to redraw all of them
 
 class Temp:
     lastTime = ""
     lastRun = 0
 
 def save(name, folder="plots", endings=[".pdf"]):
-    for ending in endings:
-        ROOT.gPad.GetCanvas().SaveAs(os.path.join(folder,name+ending))
+    with instrument.stage("save"):
+        for ending in endings:
+            instrument.count("bytes written", plotOutput.saveCanvas(ROOT.gPad.GetCanvas(), name+ending, folder))
+    instrument.count("canvases saved")
 
 def randomName():
     """
@@ -90,130 +101,222 @@ def runFromFilename(filename):
         return 0
 
 def getFromFile(filename, objectname):
+    entry = contentIndex.lookup(filename)
+    if entry and (contentIndex.isEmptyFile(entry) or objectname not in contentIndex.objectNames(entry)):
+        return None # no need to open the file
     f = ROOT.TFile(filename)
-    if f.GetSize()<5000: # DQM files sometimes are empty
+    if f.GetSize()<contentIndex.minSize: # DQM files sometimes are empty
+        f.Close()
         return None
     h = f.Get(objectname)
     h = ROOT.gROOT.CloneObject(h)
+    f.Close()
     return h
 
 def sortedDict(d):
     return collections.OrderedDict(sorted(d.items(), key=lambda t: t[0]))
 
-def getInputHists(searchPath="root-files/Run*.root"):
+def readParameters(filename):
+    """Reads bin contents and errors of all parameter histograms in one go for the parameter store."""
+    entry = contentIndex.lookup(filename)
+    if entry and (contentIndex.isEmptyFile(entry) or not contentIndex.objectNames(entry).intersection(p.name for p in parameters)):
+        return None # empty, no need to open the file
+    f = ROOT.TFile(filename)
+    if f.GetSize()<contentIndex.minSize: # DQM files sometimes are empty
+        f.Close()
+        return None
+    row = paramStore.emptyRow()
+    for ip, p in enumerate(parameters):
+        h = f.Get(p.name)
+        if not h: continue
+        paramStore.fillFromHist(row, ip, h)
+    f.Close()
+    return row
+
+def histsFromStore(store, run):
+    return histsFromRecord(paramStore.RunRecord(run, *store.row(run)))
+
+def histsFromRecord(record):
+    # transient histograms, e.g. for drawing a single run
+    run, content, error, nbins = record
+    hmap = {}
+    for ip, p in enumerate(parameters):
+        if not nbins[ip]: continue
+        h = ROOT.TH1F("{}_{}".format(p.name, run), "", int(nbins[ip]), 0, int(nbins[ip]))
+        for bin in range(1, nbins[ip]+1):
+            h.SetBinContent(bin, content[ip][bin-1])
+            h.SetBinError(bin, error[ip][bin-1])
+        hmap[p.name] = h
+    return hmap
+
+pclStoreName = "paramStorePCL.npz"
+pclPadMapName = "pclPadMap.json"
+
+class PCLPadMap:
+    """(pad index, primitive index) of the histogram in each pad of the PCL canvas"""
+    positions = None
+
+def findPCLHists(pads):
+    positions = []
+    for ip, pad in enumerate(pads):
+        for ix, x in enumerate(pad.GetListOfPrimitives()):
+            if isinstance(x, ROOT.TH1F):
+                positions.append((ip, ix))
+                break
+    return positions
+
+def getPCLHists(canvas):
+    """
+    Histograms in the PCL_SiPixAl_Expert canvas. The positions of the
+    histograms are looked up directly with the cached pad mapping, the pads
+    are only searched if the layout changed.
+    """
+    pads = canvas.GetListOfPrimitives()
+    if PCLPadMap.positions is None and os.path.exists(pclPadMapName):
+        with open(pclPadMapName) as f:
+            PCLPadMap.positions = json.load(f)
+    if PCLPadMap.positions:
+        try:
+            hists = [pads.At(ip).GetListOfPrimitives().At(ix) for ip, ix in PCLPadMap.positions]
+            if all(isinstance(h, ROOT.TH1F) for h in hists):
+                return hists
+        except (AttributeError, ReferenceError): # pad or primitive does not exist
+            pass
+    PCLPadMap.positions = findPCLHists(pads)
+    with open(pclPadMapName, "w") as f:
+        json.dump(PCLPadMap.positions, f)
+    return [pads.At(ip).GetListOfPrimitives().At(ix) for ip, ix in PCLPadMap.positions]
+
+def readPCLParameters(filename):
+    """Like readParameters, for the histograms in the canvas of PCL_SiPixAl_DQM.root files."""
+    c = getFromFile(filename, "PCL_SiPixAl_Expert")
+    if not c: return None
+    content, error, nbins = paramStore.emptyRow()
+    for h in getPCLHists(c):
+        var = h.GetName().split("_")[0]
+        if var not in paramStore.parameterNames: continue
+        ip = paramStore.parameterNames.index(var)
+        nbins[ip] = min(h.GetNbinsX(), paramStore.nBins)
+        for bin in range(1, nbins[ip]+1):
+            content[ip][bin-1] = h.GetBinContent(bin)
+            error[ip][bin-1] = h.GetBinError(bin)
+    c.Delete()
+    return content, error, nbins
+
+def getParameterStore(searchPath="root-files/Run*.root", storeName=None, beforeRead=None):
+    """
+    Returns the parameter store, reading only files which are new or changed
+    since the last call. PCL_SiPixAl_DQM.root files have their own store.
+    """
+    isPCL = searchPath.endswith("PCL_SiPixAl_DQM.root")
+    if storeName is None: storeName = pclStoreName if isPCL else paramStore.defaultStoreName
+    store = paramStore.ParameterStore(storeName)
+    reader = readPCLParameters if isPCL else readParameters
+    with instrument.stage("read parameters"):
+        store.updated = paramStore.updateStore(store, searchPath, reader, runFromFilename, beforeRead)
+    instrument.count("files scanned", len(store))
+    instrument.count("parameter cache hits", len(store) - len(store.updated))
+    instrument.count("parameter cache misses", len(store.updated))
+    if store.updated: print "Read parameters of {} new or changed runs".format(len(store.updated))
+    store.save()
+    return store
+
+def iterRunRecords(searchPath="root-files/Run*.root", minRun=-1, reverse=False, storeName=None):
+    """
+    Streaming alternative to getInputHists: yields a paramStore.RunRecord
+    (numbers only, no ROOT objects) per filled run. Files are opened only
+    if new or changed, and closed right after reading.
+    """
+    store = getParameterStore(searchPath, storeName)
+    for record in store.records(minRun, reverse):
+        yield record
+
+def getInputHists(searchPath="root-files/Run*.root", store=None):
+    # dqm plots or PCL canvases, read via the parameter store
     hists = {}
-    for filename in glob.glob(searchPath):
-        runNr = runFromFilename(filename)
-        newHists = {}
-        if searchPath.endswith("PCL_SiPixAl_DQM.root"):
-            c = getFromFile(filename, "PCL_SiPixAl_Expert")
-            for pad in c.GetListOfPrimitives():
-                pad.cd()
-                for x in pad.GetListOfPrimitives():
-                    if isinstance(x, ROOT.TH1F):
-                        newHists[x.GetName()] = x.Clone()
-                        break
-        else: # dqm plots
-            for p in parameters:
-                h = getFromFile(filename, p.name)
-                if h:
-                    newHists[p.name] = h
-        if newHists: hists[runNr] = newHists
+    if store is None: store = getParameterStore(searchPath)
+    for runNr, filled in zip(store.runs, store.isFilled()):
+        if filled: hists[int(runNr)] = histsFromStore(store, int(runNr))
     return sortedDict(hists)
 
-def exceedsCuts(h, cutDict=False):
+cutStatusNames = ["good", "update", "fail"]
+
+def classifyCuts(content, error, nbins, cuts):
+    """
+    Cut status of many histograms at once. content and error have the shape
+    (..., bins), nbins the shape (...) and cuts broadcasts against it.
+    Returns indices into cutStatusNames: a histogram fails if any bin fails,
+    otherwise it requires an update if any bin exceeds the cut significantly.
+    """
     maxErrCut = 10
     sigCut = 2.5
     maxCut = 200
+    c = numpy.abs(content)
+    e = error
+    inHist = numpy.arange(c.shape[-1]) < numpy.asarray(nbins)[...,None]
+    cut = numpy.asarray(cuts, dtype=float)[...,None]
+    fail = inHist & ((c > maxCut) | (e > maxErrCut))
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        update = inHist & ~fail & (c > cut) & (e != 0) & (c/e > sigCut)
+    return numpy.where(fail.any(axis=-1), 2, numpy.where(update.any(axis=-1), 1, 0))
+
+def getCutStatus(store):
+    """Cut status of all parameters of all runs in the store, shape (runs, parameters)."""
+    store.isFilled() # merges pending runs
+    return classifyCuts(store.content, store.error, store.nbins, [p.cut for p in parameters])
+
+def cutStatusSummary(store):
+    """Returns {run: worst status} for all filled runs."""
+    worst = getCutStatus(store).max(axis=1)
+    return collections.OrderedDict((int(r), cutStatusNames[s]) for r, s, filled in zip(store.runs, worst, store.isFilled()) if filled)
+
+def exceedsCuts(h, cutDict=False):
     var = h.GetName().split("_")[0]
     cut = parDict[var].cut
-
-    binInfos = []
-    for bin in range(1,h.GetNbinsX()+1):
-        c = abs(h.GetBinContent(bin))
-        e = h.GetBinError(bin)
-        if c > maxCut or e > maxErrCut:
-            binInfos.append("fail")
-        elif c > cut and e and c/e > sigCut:
-            binInfos.append("update")
-        else:
-            binInfos.append("good")
-    if "fail" in binInfos:
-        return "fail"
-    elif "update" in binInfos:
-        return "update"
-    else:
-        return "good"
+    n = h.GetNbinsX()
+    content = numpy.array([h.GetBinContent(bin) for bin in range(1,n+1)])
+    error = numpy.array([h.GetBinError(bin) for bin in range(1,n+1)])
+    return cutStatusNames[classifyCuts(content, error, n, cut)]
 
 def getRunEndTime(run):
     #returs a string similar to 2016-06-16 23:30:32
-    return subprocess.check_output(["das_client.py --limit=0 --query=\"run={} | grep run.end_time\"".format(run)], shell=True)
+    return dasClient.getRunInfo(run, "end_time")
 
 def getValidRunBefore(run):
-    foundRun = False
-    run -= 1
-    while not foundRun:
-        try:
-            out = subprocess.check_output(["das_client.py --limit=0 --query=\"run={} | grep run.end_time\"".format(run)], shell=True)
-            foundRun = True
-        except:
-            run -=1
-    return run
+    return dasClient.getValidRunBefore(run)
 
 
 def getFieldFromDB(run):
-    bfield = subprocess.check_output(["das_client", "--limit", "0",  "--query", "run={} | grep run.bfield".format(run)])
-    bfieldvals=re.findall("\d+\.\d+", bfield)
-    return -1 if len(bfieldvals) == 0 else bfieldvals[0]
-
-def getField(run, dbName="runField.pkl"):
-    db = {}
-    if os.path.exists(dbName):
-        with open(dbName) as f:
-            db = pickle.load(f)
-    if run not in db or db[run] == "\n":
-    	db[run] = getFieldFromDB(run)
-	print "Got B-Field for run {}: {}".format(run, db[run])
-    with open(dbName, "wb") as f:
-        pickle.dump(db, f)
-    return db[run]
+    return dasClient.getRunInfo(run, "bfield", retryInvalid=True)
+
+def getField(run, dbName=runDB.defaultDBName):
+    db = runDB.getDB(dbName)
+    if db.get(run, "bfield", dasClient.invalid) == dasClient.invalid:
+        dasClient.getRunInfo(run, "bfield", db, retryInvalid=True)
+        print "Got B-Field for run {}: {}".format(run, db.get(run, "bfield"))
+    return db.get(run, "bfield")
 
 
 def getLuminosity(minRun):
-    """Expects something like
-    +-------+------+--------+--------+-------------------+------------------+
-    | nfill | nrun | nls    | ncms   | totdelivered(/fb) | totrecorded(/fb) |
-    +-------+------+--------+--------+-------------------+------------------+
-    | 73    | 327  | 142418 | 138935 | 19.562            | 18.036           |
-    +-------+------+--------+--------+-------------------+------------------+
-    And extracts the total recorded luminosity (/fb).
-    """
-    output = subprocess.check_output(["/afs/cern.ch/user/a/auterman/.local/bin/brilcalc", "lumi", "-b", "STABLE BEAMS", "--normtag=/afs/cern.ch/user/l/lumipro/public/normtag_file/normtag_BRIL.json", "-u", "/fb", "--begin", str(minRun)])
-    return float(output.split("\n")[-4].split("|")[-2])
-
-def getTime(run, dbName="runTime.pkl"):
-    db = {}
-    if os.path.exists(dbName):
-        with open(dbName) as f:
-            db = pickle.load(f)
-    if not run in db:
-        db[run] = getRunEndTime(run)
-	db[run] = db[run].replace('"','')
-    #print "run ",run," >>>",db[run],"<<<"
+    """Total recorded luminosity (/fb) since minRun, see lumiService."""
+    return lumiService.integratedLumi(minRun)
+
+def getTime(run, dbName=runDB.defaultDBName):
+    db = runDB.getDB(dbName)
+    if db.get(run, "end_time") is None:
+        dasClient.getRunInfo(run, "end_time", db)
+    #print "run ",run," >>>",db.get(run, "end_time"),"<<<"
     lastRun=run
-    while db[run] == "\n": 
-        lastRun = getValidRunBefore(lastRun)
-        db[run] = getRunEndTime(lastRun)
-        db[run] = db[run].replace('"','')
-        print "run ",run," ->Get Time for previous run ",lastRun,": db=",db[run]
-    with open(dbName, "wb") as f:
-        pickle.dump(db, f)
-    return db[run]
+    while db.get(run, "end_time") == dasClient.invalid:
+        lastRun = dasClient.getValidRunBefore(lastRun, db=db)
+        db.set(run, "end_time", db.get(lastRun, "end_time"))
+        print "run ",run," ->Get Time for previous run ",lastRun,": db=",db.get(run, "end_time")
+    return db.get(run, "end_time")
 
 def sendMail(adress, subject="", body=""):
     os.system("echo \"{}\" | mail -s \"{}\" {}".format(body, subject, adress))
 
-def drawHists(hmap, savename, run):
+def drawHists(hmap, savename, run, cutStatus=None):
     hnames = ["Xpos", "Ypos","Zpos", "Xrot", "Yrot", "Zrot"]
     line = ROOT.TLine()
     line.SetLineColor(ROOT.kRed)
@@ -225,11 +328,11 @@ def drawHists(hmap, savename, run):
         h = hmap[hname]
         h.SetLineColor(ROOT.kBlack)
         h.SetFillColor(ROOT.kGreen-7)
-        cutStatus = exceedsCuts(h)
-        if cutStatus == "update":
+        status = cutStatus[hname] if cutStatus else exceedsCuts(h)
+        if status == "update":
             h.SetFillColor(ROOT.kOrange-9)
             dbUpdated = True
-        elif cutStatus == "fail":
+        elif status == "fail":
             h.SetFillColor(ROOT.kRed)
         for bin in range(1,7):
             h.GetXaxis().SetBinLabel(bin,objects[bin-1][0])
@@ -296,6 +399,122 @@ def drawPublicStyleHists(hmap, savename, run):
 
 
 
+class RenderWorker:
+    store = None
+    storeName = None
+    lazy = False
+    storeMTime = None
+
+def initRenderWorker(storeName, lazy=False):
+    # each process reads the histograms of its runs from the parameter store,
+    # a pool started before the store is up to date reads it with the first run
+    RenderWorker.storeName = storeName
+    RenderWorker.lazy = lazy
+    RenderWorker.store = None if lazy else paramStore.ParameterStore(storeName)
+
+def workerStore():
+    # a lazy worker reads the store again whenever it was written, watch.py
+    # keeps its pool from one poll to the next
+    if RenderWorker.lazy:
+        mtime = os.path.getmtime(RenderWorker.storeName) if os.path.exists(RenderWorker.storeName) else None
+        if RenderWorker.store is None or mtime != RenderWorker.storeMTime:
+            RenderWorker.store = paramStore.ParameterStore(RenderWorker.storeName)
+            RenderWorker.storeMTime = mtime
+    return RenderWorker.store
+
+def startRenderPool(jobs, storeName=paramStore.defaultStoreName):
+    """
+    Forks the render processes. This has to happen before any thread is
+    started: a child inheriting a lock held by a thread at fork time (e.g. of
+    the run database) would hang.
+    """
+    return multiprocessing.Pool(jobs, initRenderWorker, (storeName, True))
+
+def renderRun(run):
+    # returns the render time, or None if drawing failed
+    start = time.time()
+    try:
+        record = paramStore.RunRecord(run, *workerStore().row(run))
+        status = classifyCuts(record.content, record.error, record.nbins, [p.cut for p in parameters])
+        cutStatus = dict((p.name, cutStatusNames[s]) for p, s in zip(parameters, status))
+        drawHists(histsFromRecord(record), "Run{}".format(run), run, cutStatus)
+    except Exception as e:
+        print "Could not draw run {}: {}".format(run, e)
+        return run, None
+    if plotOutput.flush(): return run, None
+    return run, time.time() - start
+
+def renderRuns(runs, jobs=1, storeName=paramStore.defaultStoreName, store=None, pool=None):
+    """
+    Draws the parameter overview of each run. With jobs > 1 the runs are
+    distributed over a pool of processes, since ROOT is not thread safe.
+    pool: processes from startRenderPool, closed by the caller.
+    A store already in memory is used directly when drawing in this process.
+    Returns a dictionary run: render time in seconds (None if drawing failed).
+    """
+    if not runs: return {}
+    if pool is not None or jobs > 1:
+        if pool is not None:
+            renderTimes = dict(pool.imap_unordered(renderRun, runs))
+        else:
+            pool = multiprocessing.Pool(min(jobs, len(runs)), initRenderWorker, (storeName,))
+            renderTimes = dict(pool.imap_unordered(renderRun, runs))
+            pool.close()
+            pool.join()
+        # save() counts in the worker processes are lost, count the outputs here
+        if instrument.State.enabled:
+            for run, t in renderTimes.iteritems():
+                if t is None: continue
+                outputs = [x for x in runOutputs(run) if os.path.exists(x)]
+                instrument.count("canvases saved")
+                instrument.count("bytes written", sum(os.path.getsize(x) for x in outputs))
+    else:
+        if store is None: initRenderWorker(storeName)
+        else: RenderWorker.store, RenderWorker.lazy = store, False
+        renderTimes = dict(renderRun(run) for run in runs)
+    return renderTimes
+
+def printRenderSummary(renderTimes):
+    failed = [run for run, t in renderTimes.iteritems() if t is None]
+    if failed: print "Drawing failed for runs", sorted(failed)
+    renderTimes = dict((run, t) for run, t in renderTimes.iteritems() if t is not None)
+    if not renderTimes: return
+    times = sorted(renderTimes.values())
+    slowestRun = max(renderTimes, key=renderTimes.get)
+    print "Rendered {} runs in {:.1f}s, median {:.2f}s, slowest run {} ({:.2f}s)".format(
+        len(times), sum(times), times[len(times)/2], slowestRun, renderTimes[slowestRun])
+
+
+def getManifest():
+    style = os.path.join(os.path.dirname(os.path.abspath(__file__)), "style.py")
+    return renderManifest.RenderManifest(version=renderManifest.codeVersion(renderVersion, [style]))
+
+def runOutputs(run):
+    return [os.path.join(plotDir, "Run{}{}".format(run, ending)) for ending in [".pdf",".png", ".root"]]
+
+def summaryOutputs(savename, params):
+    return [os.path.join(plotDir, "{}_{}{}".format(savename, p.filename, ending)) for p in params for ending in [".pdf",".png", ".root"]]
+
+def runInputHash(store, run):
+    return renderManifest.hashInputs(*store.row(run))
+
+def findNewRuns(store, manifest, verify=False):
+    """Returns {run: input hash} of all filled runs and the runs which have to be drawn."""
+    runHashes = dict((int(run), runInputHash(store, int(run))) for run, filled in zip(store.runs, store.isFilled()) if filled)
+    newRuns = [run for run, h in sorted(runHashes.iteritems()) if not manifest.isCurrent("Run{}".format(run), h, verify)]
+    return runHashes, newRuns
+
+def renderNewRuns(runs, runHashes, manifest, jobs=1, store=None, pool=None):
+    with instrument.stage("render runs"):
+        renderTimes = renderRuns(runs, jobs, store=store, pool=pool)
+    instrument.count("runs rendered", len(runs))
+    for run, t in renderTimes.iteritems():
+        if t is not None: manifest.record("Run{}".format(run), runHashes[run], runOutputs(run))
+    manifest.save()
+    printRenderSummary(renderTimes)
+    return renderTimes
+
+
 def drawGraphsVsX(gmap, xaxis, savename, magnetGraph, params, objcts, specialRuns=[]):
     """ Options for xaxis: time, run"""
     #lumi = getLuminosity(273000)
@@ -349,7 +568,8 @@ def drawGraphsVsX(gmap, xaxis, savename, magnetGraph, params, objcts, specialRun
 	    ##end: for g,ig
         line.DrawLine(xmin, -p.cut, xmax, -p.cut)
         line.DrawLine(xmin, +p.cut, xmax, +p.cut)
-        for r in specialRuns:
+        specialRuns = numpy.asarray(specialRuns, dtype=float)
+        for r in specialRuns[(specialRuns >= xmin) & (specialRuns <= xmax)]:
             updateLine.DrawLine(r, p.minDraw, r, p.maxDraw)
         text = ROOT.TLatex()
         text.DrawLatexNDC(.08, .945, "#scale[1.2]{#font[61]{CMS}} #font[52]{Preliminary}")
@@ -361,102 +581,254 @@ def drawGraphsVsX(gmap, xaxis, savename, magnetGraph, params, objcts, specialRun
 	save(savename+"_"+p.filename, plotDir, endings=[".pdf",".png", ".root"])
 
 
+simple_parameters = [
+    Parameter("Xpos", "Xsimple", "#Deltax (#mum)", 5, -20, 45 ), \
+    Parameter("Ypos", "Ysimple", "#Deltay (#mum)", 10, -30, 50 ), \
+    Parameter("Zpos", "Zsimple", "#Deltaz (#mum)", 15, -50, 140 )
+    ]
+simple_objects = [
+    ("BPIX(x+)",    kBlue,    21),
+    ("BPIX(x-)",    kCyan,    25),
+]
+
+def drawSummaryPlots(series, seriesHash, updateRuns, updateTimes, manifest, force=False):
+    """
+    Draws the parameters of all runs vs run number and vs time, unless the
+    runs and the alignment updates did not change since the last time.
+    updateRuns and updateTimes are arrays, e.g. from getUpdateArrays.
+    """
+    filename = "MagnetHistory.txt"
+    #magnetGraphvsTime = ReadMagnetFieldHistory(filename, convertToTime=True)
+    #magnetGraphvsRun  = ReadMagnetFieldHistory(filename, convertToTime=False)
+    magnetGraphvsRun   = GetFieldHistoryByHand(convertToTime=False)
+    magnetGraphvsTime  = GetFieldHistoryByHand(convertToTime=True)
+
+    # vs run
+    vsRunHash = renderManifest.hashInputs(seriesHash, updateRuns)
+    if not manifest.isCurrent("vsRun", vsRunHash) or force:
+        with instrument.stage("summary vs run"):
+            graphsVsRun = getGraphsVsRun(series)
+            #drawGraphsVsX(graphsVsRun, "run", "vsRun", magnetGraphvsRun, updateRuns)
+            drawGraphsVsX(graphsVsRun, "run", "vsRun", magnetGraphvsRun, parameters, objects, updateRuns)
+            drawGraphsVsX(graphsVsRun, "run", "vsRun", magnetGraphvsRun, simple_parameters, simple_objects, updateRuns)
+            plotOutput.flush()
+        manifest.record("vsRun", vsRunHash, summaryOutputs("vsRun", parameters+simple_parameters))
+
+    # vs time
+    vsTimeHash = renderManifest.hashInputs(seriesHash, series.times(), updateTimes)
+    if not manifest.isCurrent("vsTime", vsTimeHash) or force:
+        with instrument.stage("summary vs time"):
+            graphsVsTime = getGraphsVsRun(series, convertToTime=True)
+            drawGraphsVsX(graphsVsTime, "time", "vsTime", magnetGraphvsTime, parameters, objects, updateTimes)
+            drawGraphsVsX(graphsVsTime, "time", "vsTime", magnetGraphvsTime, simple_parameters, simple_objects, updateTimes)
+            plotOutput.flush()
+        manifest.record("vsTime", vsTimeHash, summaryOutputs("vsTime", parameters+simple_parameters))
+
 def string2Time(timeStr):
     #print timeStr
-    return ROOT.TDatime(timeStr).Convert(0)
+    # same as ROOT.TDatime(timeStr).Convert(0), i.e. interpreted as local time
+    return int(time.mktime(time.strptime(timeStr.strip(), "%Y-%m-%d %H:%M:%S")))
 
-def getGraphsVsRun(inputHists, minRun=-1, convertToTime=False):
-    inputHists = sortedDict(dict((key,value) for key, value in inputHists.iteritems() if key >= minRun))
-    ##gdefault = ROOT.TGraphErrors()
-    gdefault = ROOT.TGraph()
+class ParameterSeries:
+    """
+    Contents of the run records >= minRun (e.g. from iterRunRecords or
+    ParameterStore.records) as contiguous arrays, shared by the graphs versus
+    run and versus time. Only the object bins of each record are kept.
+    valid[run, parameter, object] excludes empty bins and large errors.
+    """
+    def __init__(self, records, minRun=-1):
+        nObjects = len(objects)
+        runs, content, error, nbins = [], [], [], []
+        for record in records:
+            if record.run < minRun: continue
+            runs.append(record.run)
+            content.append(record.content[:,:nObjects])
+            error.append(record.error[:,:nObjects])
+            nbins.append(record.nbins)
+        shape = (len(runs), len(parameters), nObjects)
+        self.runs = numpy.array(runs, dtype=numpy.int64)
+        self.content = numpy.array(content, dtype=float).reshape(shape)
+        error = numpy.array(error, dtype=float).reshape(shape)
+        nbins = numpy.array(nbins, dtype=numpy.int16).reshape(shape[:2])
+        self.present = (nbins > 0).any(axis=0)
+        inHist = numpy.arange(nObjects) < nbins[:,:,None]
+        self.valid = inHist & (numpy.abs(self.content) >= 1e-15) & (numpy.abs(error) <= 50)
+        self._times = None
+
+    def times(self):
+        if self._times is None:
+            self._times = numpy.array([string2Time(getTime(int(run))) for run in self.runs], dtype=float)
+        return self._times
+
+def getGraphsVsRun(series, convertToTime=False):
+    xVar = series.times() if convertToTime else series.runs.astype(float)
     graphsVsRun = {}
-    #showFirstAfter281000 = False
-    for iRun, (runNr, hmap) in enumerate(inputHists.iteritems()):
-        xVar = string2Time(getTime(runNr)) if convertToTime else runNr
-        for hname, h in hmap.iteritems():
-            if hname not in graphsVsRun: graphsVsRun[hname] = dict([(obj[0],gdefault.Clone()) for obj in objects ])
-            for bin in range(1,7):
-                c = h.GetBinContent(bin)
-		#if c == 0: continue
-                e = h.GetBinError(bin)
-                if abs(c) < 1e-15 or abs(e) > 50: continue
-                n = graphsVsRun[hname][objects[bin-1][0]].GetN()
-		##e.g. graphsVsRun[Xpos][FPIX(x+,z-)]
-                graphsVsRun[hname][objects[bin-1][0]].SetPoint(n, xVar, c)
-		#if not showFirstAfter281000 and not convertToTime and xVar>284658:
-		#   print "First Run After Magnet back at 3.8T: ",xVar
-		#   showFirstAfter281000 = 1
+    for ip, p in enumerate(parameters):
+        if not series.present[ip]: continue
+        graphsVsRun[p.name] = {}
+        for io, obj in enumerate(objects):
+            ##e.g. graphsVsRun[Xpos][FPIX(x+,z-)]
+            mask = series.valid[:,ip,io]
+            x = numpy.ascontiguousarray(xVar[mask])
+            y = numpy.ascontiguousarray(series.content[:,ip,io][mask])
+            graphsVsRun[p.name][obj[0]] = ROOT.TGraph(len(x), x, y) if len(x) else ROOT.TGraph()
     return graphsVsRun
 
+# placeholders of indexTemplate.html which are not filled by every caller
+templateDefaults = {"archive": ""}
+
 def updateFile(source, dest, changes={}):
     with open(source) as f:
         x = string.Template(f.read())
     with open(dest, "w") as f:
-        f.write(x.safe_substitute(changes))
+        f.write(x.safe_substitute(dict(templateDefaults, **changes)))
 
 def getNthLastRun(inputHists, N):
     sortedRuns = sorted(inputHists.keys())
     return sortedRuns[-min(N, len(sortedRuns))]
 
-def isFilledRun(hmap):
-    globalMax = 0
-    for k, v in hmap.iteritems():
-        for bin in range(1,7):
-            globalMax = max(globalMax, v.GetBinContent(bin))
+def isFilledRun(record):
+    content = record.content[:,:len(objects)][record.nbins > 0]
+    globalMax = max(0, content.max()) if content.size else 0
     return abs(globalMax) > 1e-6
 
-def getTableString(inputHists, maxPlots=5):
-    inputHists = collections.OrderedDict(reversed(list(inputHists.items())))
-    outString = "<table>\n<tr> <td> Run </td> <td> End time </td> <td>Parameters</td> </tr>"
-    for run, hmap in inputHists.iteritems():
-        link = "No results"
-        if isFilledRun(hmap):
-            if maxPlots > 0:
-                link = "<a href=plots/Run{0}.pdf><img src='plots/Run{0}.png' border='0'/></a>".format(run)
-                maxPlots -= 1
-            else:
-                link = "<a href=plots/Run{0}.pdf>pdf</a>".format(run)
-        outString += "\n<tr> <td>{0}</td> <td>{1}</td> <td>{2}</td> </tr>".format(run, getTime(run), link)
-    outString += "\n</table>"
-    return outString
+def getTableString(records, maxPlots=5, cutStatus=None):
+    """
+    records: run records ordered from the newest to the oldest run, e.g.
+    iterRunRecords(reverse=True). cutStatus: optional {run: status} from
+    cutStatusSummary, shown as additional column
+    """
+    rows = [(record.run, tableRow(record, cutStatus)) for record in records]
+    return htmlIndex.tableString(rows, maxPlots, bool(cutStatus))
+
+def tableRow(record, cutStatus=None):
+    return {"filled": bool(isFilledRun(record)), "endTime": getTime(record.run),
+        "status": cutStatus.get(record.run, "") if cutStatus else ""}
+
+def updateIndex(store, source, destDir, changes={}, maxPlots=5, cutStatus=None, cacheName=htmlIndex.defaultRowCacheName):
+    """
+    Writes the landing page and the archive pages of the run table. Rows are
+    taken from the row cache unless the parameters or the status of the run
+    changed.
+    """
+    cache = htmlIndex.RowCache(cacheName)
+    status = lambda run: cutStatus.get(run, "") if cutStatus else ""
+    rowHash = lambda record: renderManifest.hashInputs(record.content, record.error, record.nbins, status(record.run))
+    rows = htmlIndex.updateRows(cache, store.records(reverse=True), rowHash, lambda record: tableRow(record, cutStatus))
+    written = htmlIndex.writeIndex(rows, cache, source, destDir, changes, maxPlots, bool(cutStatus))
+    cache.save()
+    return written
 
 def getUpdateRuns(tag):
-    out = subprocess.check_output(["conddb", "list", tag])
-    return [int(x.split()[0]) for x in out.split("\n")[2:] if x]
+    cache = iovCache.getCache()
+    cache.update(tag)
+    return cache.runs(tag)
+
+def updateTime(run):
+    return string2Time(getTime(run))
+
+def getUpdateArrays(tags, minRun):
+    """
+    Update runs >= minRun of all tags and their times as arrays, from the
+    IOV cache. conddb is only asked if the cached IOVs of a tag expired,
+    and run information and times are only looked up for new update runs.
+    """
+    cache = iovCache.getCache()
+    for tag in tags: cache.update(tag)
+    runs, times = cache.arrays(tags, minRun)
+    dasClient.prefetchRunInfos([int(r) for r in runs if int(r) not in cache.times])
+    return cache.arrays(tags, minRun, updateTime)
+
+def knownUpdateRuns(tags, minRun):
+    """
+    Update runs >= minRun of all tags, without their times. conddb is only
+    asked if the cached IOVs of a tag expired, without it the cached runs
+    are returned.
+    """
+    cache = iovCache.getCache()
+    for tag in tags:
+        try:
+            cache.update(tag)
+        except Exception as e:
+            print "Could not update the IOVs of {}: {} {}".format(tag, type(e).__name__, e)
+    return cache.arrays(tags, minRun)[0]
+
+def summaryHash(seriesHash, updateRuns):
+    # the summary plots change with the parameter series and the update runs
+    return renderManifest.hashInputs(seriesHash, numpy.asarray(updateRuns, dtype=numpy.int64))
+
+def startMetadataPrefetch(runs, tags, minRun, jobs=4, timeout=900):
+    """
+    Starts the external lookups for the summary plots (conddb, DAS and
+    brilcalc) in background threads, so they run concurrently with each other
+    and with reading the ROOT files. The results are collected with
+    prefetcher.get(name), which waits at most timeout seconds.
+    """
+    prefetcher = prefetch.Prefetcher(jobs, timeout)
+    prefetcher.submit("updates", getUpdateArrays, tags, minRun)
+    prefetcher.submit("runInfos", dasClient.prefetchRunInfos, [r for r in runs if r >= minRun])
+    prefetcher.submit("lumi", lumiService.updateLumi, minRun)
+    return prefetcher
 
 
 def stringToSqlTimeString(timeStr):
     return timeStr.replace(".", "-")
 
-def getRunFromTime(inputTime, dbFile ="runTime.pkl"):
+class TimeIndex:
+    """End times of all runs as sorted epoch array for binary searches."""
+    def __init__(self, db):
+        self.revision = db.revision
+        pairs = []
+        for run, timeStr in db.items("end_time").iteritems():
+            try:
+                pairs.append((string2Time(timeStr), run))
+            except (ValueError, AttributeError): # runs without valid time
+                pass
+        pairs.sort()
+        self.times = numpy.array([t for t, r in pairs], dtype=float)
+        self.runs = numpy.array([r for t, r in pairs], dtype=int)
+
+    def runsFromTimes(self, times):
+        """First run ending after each of the times, 0 if there is none."""
+        idx = numpy.searchsorted(self.times, numpy.asarray(times, dtype=float), side="right")
+        if not len(self.runs): return numpy.zeros(len(idx), dtype=int)
+        return numpy.where(idx < len(self.runs), self.runs[numpy.minimum(idx, len(self.runs)-1)], 0)
+
+_timeIndices = {}
+
+def getTimeIndex(dbName=runDB.defaultDBName):
+    # rebuilt only if run times were added since the last call
+    db = runDB.getDB(dbName)
+    if dbName not in _timeIndices or _timeIndices[dbName].revision != db.revision:
+        _timeIndices[dbName] = TimeIndex(db)
+    return _timeIndices[dbName]
+
+def getRunsFromTimes(inputTimes, dbName=runDB.defaultDBName):
+    return getTimeIndex(dbName).runsFromTimes(inputTimes)
+
+def getRunFromTime(inputTime, dbName=runDB.defaultDBName):
     #time is ROOT::TDatime
     #sqlTimeStr = stringToSqlTimeString(time)
-    with open(dbFile) as f:
-        db = pickle.load(f)
-    timeConvertedDb = dict( [(run, string2Time(time)) for run,time in db.iteritems()])
-    for run, time in sorted(timeConvertedDb.iteritems(), key=itemgetter(1)):
-        if inputTime < time: return run
-    print "No matching run found"
-    return 0
+    run = int(getRunsFromTimes([inputTime], dbName)[0])
+    if not run: print "No matching run found"
+    return run
     
     
 def ReadMagnetFieldHistory(filename, convertToTime=False):
     mgnt = ROOT.TGraphErrors()
     with open(filename) as f:
-        content = f.readlines()
-        for i, line in enumerate(content):
-            timeStr, fieldStr = line.split(",")
-	    
-            time = string2Time(stringToSqlTimeString(timeStr))
-            field = float(fieldStr)
-	    if not convertToTime:
-	        run = getRunFromTime(time)
-		if run!=0:
-		   print time, run
-		   mgnt.SetPoint(i, run, 0)
-	    else:
-                mgnt.SetPoint(i, time, 0)
-            mgnt.SetPointError(i, 0, 50 if field>3.7 else 0)
+        content = [line.split(",") for line in f.readlines()]
+    times = [string2Time(stringToSqlTimeString(timeStr)) for timeStr, fieldStr in content]
+    runs = getRunsFromTimes(times) if not convertToTime else None
+    for i, (timeStr, fieldStr) in enumerate(content):
+        field = float(fieldStr)
+        if not convertToTime:
+            if runs[i]!=0:
+                print times[i], runs[i]
+                mgnt.SetPoint(i, runs[i], 0)
+        else:
+            mgnt.SetPoint(i, times[i], 0)
+        mgnt.SetPointError(i, 0, 50 if field>3.7 else 0)
     return mgnt
 
 def GetFieldHistoryByHand(convertToTime=False):
@@ -479,55 +851,77 @@ def GetFieldHistoryByHand(convertToTime=False):
 
 
 if __name__ == "__main__":
-    #downloadViaJson.getGridCertificat()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="Number of processes drawing the plots of new runs")
+    parser.add_argument("--force", action="store_true", help="Redraw the summary plots even if no new runs exist")
+    parser.add_argument("--verify", action="store_true", help="Redraw runs whose plots are missing on disk")
+    parser.add_argument("--prefetch-jobs", type=int, default=4, help="Number of concurrent external metadata lookups")
+    parser.add_argument("--timeout", type=float, default=externalCommands.defaultTimeout, help="Timeout in seconds for each external lookup")
+    parser.add_argument("--defer-formats", default="", help="Comma separated formats (e.g. pdf,root) published only at the end of the job")
+    parser.add_argument("--writers", type=int, default=plotOutput.writerThreads, help="Number of threads moving plots to the plot directory")
+    parser.add_argument("--report", help="Write timers and counters of the stages as json to this file")
+    parser.add_argument("--profile", help="Write cProfile statistics to this file")
+    args = parser.parse_args()
+    externalCommands.defaultTimeout = args.timeout
+    plotOutput.deferredEndings = ["."+x for x in args.defer_formats.split(",") if x]
+    plotOutput.writer.jobs = args.writers
+    # registered at exit, since the job may stop early if there is nothing to do
+    if args.report:
+        instrument.enable()
+        atexit.register(instrument.writeReport, args.report)
+    if args.profile:
+        profiler = cProfile.Profile()
+        atexit.register(profiler.dump_stats, args.profile)
+        atexit.register(profiler.disable)
+        profiler.enable()
+
+    # before the metadata prefetch starts its threads
+    renderPool = startRenderPool(args.jobs) if args.jobs > 1 else None
+
+    #import downloadViaJson
     #downloadViaJson.downloadViaJson()
-    inputHists = getInputHists()
+    updateTags = ["TrackerAlignment_PCL_byRun_v0_express"]
+    prefetchers = []
+    def startPrefetch(runs):
+        prefetchers.append(startMetadataPrefetch(runs, updateTags, 278888, args.prefetch_jobs, 2*args.timeout))
+    store = getParameterStore(beforeRead=startPrefetch)
 
     # draw new runs:
-    alreadyPlotted = [ int(x[3:9]) for x in os.listdir(plotDir) if x.endswith(".pdf") and x.startswith("Run")]
-    for run, hmap in inputHists.iteritems():
-        if run not in alreadyPlotted:
-            drawHists(hmap, "Run{}".format(run), run)
-        #if run == 285090: drawPublicStyleHists(hmap, "Run285090", 285090)
-        #if run == 285216: drawPublicStyleHists(hmap, "Run285216", 285216)
+    manifest = getManifest()
+    runHashes, newRuns = findNewRuns(store, manifest, args.verify)
+    series = ParameterSeries(store.records(), 278887)
+    seriesHash = renderManifest.hashInputs(series.runs, series.content, series.valid)
+    if not newRuns and not args.force and manifest.isCurrent("series", summaryHash(seriesHash, knownUpdateRuns(updateTags, 278888))):
+        print "No new runs or update runs, nothing to do"
+        plotOutput.publishDeferred() # left over from an interrupted job
+        if renderPool: renderPool.terminate()
+        sys.exit(0)
+    if not prefetchers: startPrefetch([int(x) for x in store.runs])
+    prefetcher = prefetchers[0]
+    renderNewRuns(newRuns, runHashes, manifest, args.jobs, pool=renderPool)
+    if renderPool:
+        renderPool.close()
+        renderPool.join()
+    cutStatus = cutStatusSummary(store)
+    print "Cut status of {} runs: {}".format(len(cutStatus), ", ".join("{} {}".format(cutStatus.values().count(x), x) for x in cutStatusNames))
+    #drawPublicStyleHists(histsFromStore(store, 285090), "Run285090", 285090)
+    #drawPublicStyleHists(histsFromStore(store, 285216), "Run285216", 285216)
 
-    filename = "MagnetHistory.txt"
-    #magnetGraphvsTime = ReadMagnetFieldHistory(filename, convertToTime=True)
-    #magnetGraphvsRun  = ReadMagnetFieldHistory(filename, convertToTime=False)
-    magnetGraphvsRun   = GetFieldHistoryByHand(convertToTime=False)
-    magnetGraphvsTime  = GetFieldHistoryByHand(convertToTime=True)
-
-
-    simple_parameters = [
-        Parameter("Xpos", "Xsimple", "#Deltax (#mum)", 5, -20, 45 ), \
-        Parameter("Ypos", "Ysimple", "#Deltay (#mum)", 10, -30, 50 ), \
-        Parameter("Zpos", "Zsimple", "#Deltaz (#mum)", 15, -50, 140 )
-        ]
-    parDict = collections.OrderedDict( (p.name, p) for p in simple_parameters )
-    simple_objects = [
-        ("BPIX(x+)",    ROOT.kBlue,    21),
-        ("BPIX(x-)",    ROOT.kCyan,    25),
-    ]
-
-
-    # vs run
     #updateRuns = [x for x in getUpdateRuns("TrackerAlignment_PCL_byRun_v0_express") if x >= 273000]
-    updateRuns = [x for x in getUpdateRuns("TrackerAlignment_PCL_byRun_v0_express") if x >= 278888]
-    updateFields = [getField(x) for x in updateRuns]
-    graphsVsRun = getGraphsVsRun(inputHists, 278887)
-    #drawGraphsVsX(graphsVsRun, "run", "vsRun", magnetGraphvsRun, updateRuns)
-    drawGraphsVsX(graphsVsRun, "run", "vsRun", magnetGraphvsRun, parameters, objects, updateRuns)
-    drawGraphsVsX(graphsVsRun, "run", "vsRun", magnetGraphvsRun, simple_parameters, simple_objects, updateRuns)
-
-    # vs time
-    updateTimes = [string2Time(getTime(x)) for x in updateRuns]
-    graphsVsTime = getGraphsVsRun(inputHists, 278887, convertToTime=True)
-    drawGraphsVsX(graphsVsTime, "time", "vsTime", magnetGraphvsTime, parameters, objects, updateTimes)
-    drawGraphsVsX(graphsVsTime, "time", "vsTime", magnetGraphvsTime, simple_parameters, simple_objects, updateTimes)
-#    updateFile("indexTemplate.html", "/afs/cern.ch/user/a/auterman/public/index.html",
-#        {
-#            "date": datetime.datetime.today().isoformat(' '),
-#            "table": getTableString(inputHists)
-#        })
+    with instrument.stage("wait for metadata"):
+        # without conddb, the update runs known from earlier calls are drawn
+        updateRuns, updateTimes = prefetcher.get("updates") or iovCache.getCache().cachedArrays(updateTags, 278888)
+        prefetcher.get("runInfos")
+        prefetcher.get("lumi")
+        prefetcher.close()
+    drawSummaryPlots(series, seriesHash, updateRuns, updateTimes, manifest, args.force)
+    with instrument.stage("publish deferred"):
+        plotOutput.publishDeferred()
+    manifest.record("series", summaryHash(seriesHash, updateRuns), [])
+    manifest.save()
+    runDB.flushAll()
+#    with instrument.stage("index"):
+#        updateIndex(store, "indexTemplate.html", "/afs/cern.ch/user/a/auterman/public",
+#            {"date": datetime.datetime.today().isoformat(' ')}, cutStatus=cutStatus)
 
 
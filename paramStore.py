@@ -0,0 +1,191 @@
+#!/usr/bin/env python2
+# On-disk table of the per-run alignment parameters, so that the ROOT files
+# have to be opened only once after they are downloaded.
+
+import os
+import glob
+import numpy
+import collections
+
+import atomicFile
+
+parameterNames = ["Xpos", "Ypos", "Zpos", "Xrot", "Yrot", "Zrot"]
+nBins = 8 # six alignable objects, bin 8 may contain the cut
+
+defaultStoreName = "paramStore.npz"
+
+# numeric content of one run, content and error have the shape (parameters, bins)
+RunRecord = collections.namedtuple("RunRecord", ["run", "content", "error", "nbins"])
+
+class ParameterStore(object):
+    """
+    Table keyed by run number holding bin contents and errors of the six
+    parameter histograms, together with modification time and size of the
+    file they were read from. nbins == 0 marks a missing histogram, a run
+    where all parameters are missing corresponds to an empty file.
+    """
+    def __init__(self, filename=defaultStoreName):
+        self.filename = filename
+        self.runs = numpy.zeros(0, dtype=numpy.int64)
+        self.content = numpy.zeros((0, len(parameterNames), nBins))
+        self.error = numpy.zeros((0, len(parameterNames), nBins))
+        self.nbins = numpy.zeros((0, len(parameterNames)), dtype=numpy.int16)
+        self.mtime = numpy.zeros(0)
+        self.size = numpy.zeros(0, dtype=numpy.int64)
+        self._index = {}
+        self._pending = {}
+        self._removed = set() # runs removed by keepOnly since the last save
+        self.changed = False
+        if filename and os.path.exists(filename):
+            self.load()
+
+    def load(self):
+        data = numpy.load(self.filename)
+        for name in ["runs", "content", "error", "nbins", "mtime", "size"]:
+            setattr(self, name, data[name])
+        data.close()
+        self._reindex()
+
+    def save(self, merge=True):
+        """
+        Writes the table atomically, only if anything has changed. The
+        download and watch.py write the same file, so with merge the runs
+        stored on disk meanwhile are added first.
+        """
+        self._consolidate()
+        if not self.changed: return
+        if merge and os.path.exists(self.filename): self.merge(ParameterStore(self.filename))
+        atomicFile.writeAtomic(self.filename, lambda f: numpy.savez(f, runs=self.runs, content=self.content,
+            error=self.error, nbins=self.nbins, mtime=self.mtime, size=self.size), "wb")
+        self._removed = set()
+        self.changed = False
+
+    def merge(self, other):
+        """
+        Takes over the runs of other which are not here or were read from a
+        newer file, except runs removed by keepOnly.
+        """
+        for i, run in enumerate(other.runs):
+            run = int(run)
+            if run in self._removed: continue
+            if run in self and self._row(run)[3] >= other.mtime[i]: continue
+            self.set(run, other.content[i], other.error[i], other.nbins[i], other.mtime[i], other.size[i])
+        self._consolidate()
+
+    def _row(self, run):
+        if run in self._pending: return self._pending[run]
+        i = self._index[run]
+        return self.content[i], self.error[i], self.nbins[i], self.mtime[i], self.size[i]
+
+    def _reindex(self):
+        self._index = dict((int(r), i) for i, r in enumerate(self.runs))
+
+    def _consolidate(self):
+        if not self._pending: return
+        runs = sorted(self._pending)
+        rows = [self._pending[r] for r in runs]
+        self.runs = numpy.concatenate([self.runs, numpy.array(runs, dtype=numpy.int64)])
+        self.content = numpy.concatenate([self.content, numpy.array([x[0] for x in rows]).reshape(-1, len(parameterNames), nBins)])
+        self.error = numpy.concatenate([self.error, numpy.array([x[1] for x in rows]).reshape(-1, len(parameterNames), nBins)])
+        self.nbins = numpy.concatenate([self.nbins, numpy.array([x[2] for x in rows], dtype=numpy.int16).reshape(-1, len(parameterNames))])
+        self.mtime = numpy.concatenate([self.mtime, numpy.array([x[3] for x in rows])])
+        self.size = numpy.concatenate([self.size, numpy.array([x[4] for x in rows], dtype=numpy.int64)])
+        self._pending = {}
+        order = numpy.argsort(self.runs, kind="mergesort")
+        for name in ["runs", "content", "error", "nbins", "mtime", "size"]:
+            setattr(self, name, getattr(self, name)[order])
+        self._reindex()
+
+    def __contains__(self, run):
+        return run in self._index or run in self._pending
+
+    def __len__(self):
+        return len(self._index) + len(self._pending)
+
+    def isCurrent(self, run, mtime, size):
+        if run not in self:
+            return False
+        row = self._row(run)
+        return row[3] == mtime and row[4] == size
+
+    def set(self, run, content, error, nbins, mtime, size):
+        """Adds or replaces the entry for a run. content and error have the shape (parameters, bins)."""
+        self.changed = True
+        self._removed.discard(run)
+        if run in self._index:
+            i = self._index[run]
+            self.content[i], self.error[i], self.nbins[i] = content, error, nbins
+            self.mtime[i], self.size[i] = mtime, size
+        else:
+            self._pending[run] = (content, error, nbins, mtime, size)
+
+    def keepOnly(self, runs):
+        """Removes all runs not contained in runs, e.g. files which were deleted."""
+        self._consolidate()
+        mask = numpy.in1d(self.runs, numpy.array(sorted(runs), dtype=numpy.int64))
+        if mask.all(): return
+        self._removed.update(int(r) for r in self.runs[~mask])
+        for name in ["runs", "content", "error", "nbins", "mtime", "size"]:
+            setattr(self, name, getattr(self, name)[mask])
+        self._reindex()
+        self.changed = True
+
+    def isFilled(self):
+        """Mask of runs for which at least one parameter was found."""
+        self._consolidate()
+        return (self.nbins > 0).any(axis=1)
+
+    def row(self, run):
+        self._consolidate()
+        i = self._index[run]
+        return self.content[i], self.error[i], self.nbins[i]
+
+    def records(self, minRun=-1, reverse=False):
+        """Yields a RunRecord for every run >= minRun with at least one parameter."""
+        filled = self.isFilled()
+        indices = range(len(self.runs))
+        for i in reversed(indices) if reverse else indices:
+            if filled[i] and self.runs[i] >= minRun:
+                yield RunRecord(int(self.runs[i]), self.content[i], self.error[i], self.nbins[i])
+
+def emptyRow():
+    return numpy.zeros((len(parameterNames), nBins)), numpy.zeros((len(parameterNames), nBins)), numpy.zeros(len(parameterNames), dtype=numpy.int16)
+
+def fillFromHist(row, ip, h):
+    """Copies bin contents and errors of the histogram h of parameter ip into row."""
+    content, error, nbins = row
+    nbins[ip] = min(h.GetNbinsX(), nBins)
+    for bin in range(1, nbins[ip]+1):
+        content[ip][bin-1] = h.GetBinContent(bin)
+        error[ip][bin-1] = h.GetBinError(bin)
+
+def findOutdated(store, searchPath, runFromFilename):
+    """Returns the runs of all files matching searchPath and (run, filename, stat) of the new or changed ones."""
+    runs = []
+    outdated = []
+    for filename in glob.glob(searchPath):
+        run = runFromFilename(filename)
+        runs.append(run)
+        stat = os.stat(filename)
+        if not store.isCurrent(run, stat.st_mtime, stat.st_size):
+            outdated.append((run, filename, stat))
+    return runs, outdated
+
+def updateStore(store, searchPath, reader, runFromFilename, beforeRead=None, ready=None):
+    """
+    Reads all files matching searchPath which are new or changed since they
+    were stored. reader(filename) returns (content, error, nbins) or None for
+    empty files. If files have to be read, beforeRead(runs) is called with
+    all runs first, e.g. to start other work in the meantime. Files for which
+    ready(filename, stat) is false are left for a later call.
+    Returns the list of runs which have been (re)read.
+    """
+    runs, outdated = findOutdated(store, searchPath, runFromFilename)
+    if ready: outdated = [x for x in outdated if ready(x[1], x[2])]
+    if outdated and beforeRead: beforeRead(sorted(runs))
+    for run, filename, stat in outdated:
+        row = reader(filename)
+        if row is None: row = emptyRow()
+        store.set(run, row[0], row[1], row[2], stat.st_mtime, stat.st_size)
+    store.keepOnly(runs)
+    return sorted(run for run, filename, stat in outdated)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python2
+# Writing the plots to the (slow, network) plot directory. Canvases are saved
+# to a local scratch directory, and the files are moved into place by a pool
+# of writer threads, so ROOT can draw the next canvas meanwhile. Formats in
+# deferredEndings stay in scratch until publishDeferred() is called, e.g. at
+# the end of the job, so the PNGs for the web page appear first.
+
+import os
+import errno
+import shutil
+import hashlib
+import time
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+import atomicFile
+
+scratchDir = os.getenv("PLOT_SCRATCH", os.path.join(tempfile.gettempdir(), "pixelAlignmentPlots"))
+writerThreads = 4
+deferredEndings = [] # e.g. [".pdf", ".root"]
+staleAge = 86400. # seconds after which files left half written by a killed job are removed
+
+def publish(source, dest):
+    """Moves source to dest, such that dest never exists half written."""
+    try:
+        os.rename(source, dest) # same file system
+        return
+    except OSError:
+        pass
+    with open(source, "rb") as f:
+        atomicFile.writeAtomic(dest, lambda out: shutil.copyfileobj(f, out), "wb")
+    os.remove(source)
+
+def makeDirs(path):
+    # several render processes may create the same directory at once
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST: raise
+
+def deferredDir(folder):
+    # one directory per destination, with the destination written into it
+    path = os.path.join(scratchDir, "deferred", hashlib.sha1(os.path.abspath(folder)).hexdigest()[:12])
+    if not os.path.isdir(path):
+        makeDirs(path)
+        with open(os.path.join(path, ".destination"), "w") as f:
+            f.write(os.path.abspath(folder))
+    return path
+
+class Writer:
+    def __init__(self, jobs=writerThreads):
+        self.jobs = jobs
+        self.pool = None
+        self.pid = None
+        self.pending = []
+
+    def submit(self, source, dest):
+        if self.pid != os.getpid():
+            # a forked render process does not inherit the threads
+            self.pool = ThreadPool(self.jobs)
+            self.pid = os.getpid()
+            self.pending = []
+        self.pending.append((dest, self.pool.apply_async(publish, (source, dest))))
+
+    def wait(self):
+        """Waits until all submitted files are in place. Returns the files which could not be written."""
+        failed = []
+        for dest, result in self.pending:
+            try:
+                result.get()
+            except Exception as e:
+                print "Could not write {}: {}".format(dest, e)
+                failed.append(dest)
+        self.pending = []
+        return failed
+
+writer = Writer()
+
+def saveCanvas(canvas, filename, folder):
+    """
+    Saves the canvas locally and publishes it to folder/filename in the
+    background, or later if the format is deferred. Returns the file size.
+    """
+    if not os.path.isdir(scratchDir): makeDirs(scratchDir)
+    ending = os.path.splitext(filename)[1]
+    if ending in deferredEndings:
+        # publishDeferred skips dot files, the file gets its name once it is complete
+        local = os.path.join(deferredDir(folder), ".{}_{}".format(os.getpid(), filename))
+    else:
+        local = os.path.join(scratchDir, "{}_{}".format(os.getpid(), filename))
+    canvas.SaveAs(local)
+    size = os.path.getsize(local) if os.path.exists(local) else 0
+    if ending in deferredEndings:
+        if os.path.exists(local): os.rename(local, os.path.join(os.path.dirname(local), filename))
+    else:
+        writer.submit(local, os.path.join(folder, filename))
+    return size
+
+def flush():
+    return writer.wait()
+
+def publishDeferred():
+    """Moves all deferred files, also those left by earlier jobs, to their destination."""
+    flush()
+    base = os.path.join(scratchDir, "deferred")
+    if not os.path.isdir(base): return 0
+    n = 0
+    for sub in os.listdir(base):
+        path = os.path.join(base, sub)
+        with open(os.path.join(path, ".destination")) as f:
+            folder = f.read()
+        for filename in os.listdir(path):
+            if filename.startswith("."):
+                tmpName = os.path.join(path, filename)
+                if filename != ".destination" and time.time() - os.path.getmtime(tmpName) > staleAge:
+                    os.remove(tmpName)
+                continue
+            writer.submit(os.path.join(path, filename), os.path.join(folder, filename))
+            n += 1
+    flush()
+    return n
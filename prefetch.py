@@ -0,0 +1,28 @@
+#!/usr/bin/env python2
+# Runs independent, mostly waiting tasks (external metadata lookups) in a
+# bounded thread pool while the main thread continues, e.g. with ROOT I/O.
+
+from multiprocessing.pool import ThreadPool
+
+class Prefetcher:
+    def __init__(self, maxWorkers=4, timeout=900):
+        self.pool = ThreadPool(maxWorkers)
+        self.timeout = timeout
+        self.results = {}
+
+    def submit(self, name, func, *args):
+        self.results[name] = self.pool.apply_async(func, args)
+
+    def get(self, name, default=None):
+        """
+        Waits for the task at most timeout seconds. Failed or timed out tasks
+        are reported and default is returned, so the caller can fall back.
+        """
+        try:
+            return self.results[name].get(self.timeout)
+        except Exception as e:
+            print "Prefetching {} failed: {} {}".format(name, type(e).__name__, e)
+            return default
+
+    def close(self):
+        self.pool.close()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python2
+# Remembers which plots have been drawn from which input, so that plots are
+# only redrawn if their input, the plotting code version or the style changed,
+# and plots whose drawing failed are tried again.
+
+import os
+import json
+import hashlib
+
+import atomicFile
+
+defaultManifestName = "renderManifest.json"
+
+def hashInputs(*inputs):
+    """Content hash of numpy arrays, strings and numbers."""
+    h = hashlib.sha1()
+    for x in inputs:
+        if hasattr(x, "tobytes"):
+            h.update(str(x.dtype) + str(x.shape))
+            h.update(x.tobytes())
+        else:
+            h.update(repr(x))
+        h.update("|")
+    return h.hexdigest()
+
+def codeVersion(version, files):
+    """Combines a manually bumped version with the content of e.g. the style definition."""
+    h = hashlib.sha1(str(version))
+    for fname in files:
+        with open(fname) as f:
+            h.update(f.read())
+    return h.hexdigest()[:12]
+
+class RenderManifest:
+    def __init__(self, filename=defaultManifestName, version=""):
+        self.filename = filename
+        self.version = version
+        self.entries = {}
+        self.changed = False
+        if filename and os.path.exists(filename):
+            with open(filename) as f:
+                self.entries = json.load(f)
+
+    def isCurrent(self, key, inputHash, verifyOutputs=False):
+        """
+        True if the plot key was drawn from the same input with the same code
+        version. The outputs are only checked on disk if verifyOutputs is set,
+        to avoid one stat per plot on slow file systems.
+        """
+        entry = self.entries.get(key)
+        if not entry or entry["input"] != inputHash or entry["version"] != self.version:
+            return False
+        return not verifyOutputs or all(os.path.exists(x) for x in entry["outputs"])
+
+    def record(self, key, inputHash, outputs):
+        # call only after all outputs have been written
+        self.entries[key] = {"input": inputHash, "version": self.version, "outputs": outputs}
+        self.changed = True
+
+    def save(self):
+        if not self.changed: return
+        atomicFile.writeAtomic(self.filename, lambda f: json.dump(self.entries, f, indent=0, sort_keys=True))
+        self.changed = False
@@ -0,0 +1,95 @@
+#!/usr/bin/env python2
+# Run metadata (start/end time, B-field, validity, luminosity) shared by
+# makePlots.py and updateDB.py. The database is loaded once per process,
+# modified in memory and written back at the end of the job.
+
+import os
+import atexit
+import pickle
+import threading
+
+import atomicFile
+
+defaultDBName = "runDB.pkl"
+fields = ["start_time", "end_time", "bfield", "isValid", "lumi"]
+
+# older per-quantity databases, imported when runDB.pkl does not exist yet
+legacyDBs = {
+    "runTime.pkl": "end_time",
+    "runField.pkl": "bfield",
+}
+
+class RunDB(object):
+    def __init__(self, dbName=defaultDBName):
+        self.dbName = dbName
+        self.db = {}
+        self.changed = False
+        self.revision = 0 # counts modifications, e.g. to rebuild derived indices
+        self.lock = threading.Lock() # prefetching threads fill the database concurrently
+        if os.path.exists(dbName):
+            with open(dbName) as f:
+                self.db = pickle.load(f)
+        else:
+            self.importLegacy(os.path.dirname(dbName))
+
+    def importLegacy(self, folder):
+        for name, field in legacyDBs.iteritems():
+            fname = os.path.join(folder, name)
+            if not os.path.exists(fname): continue
+            with open(fname) as f:
+                for run, value in pickle.load(f).iteritems():
+                    self.set(run, field, value)
+        fname = os.path.join(folder, "runInfo.pkl")
+        if os.path.exists(fname):
+            with open(fname) as f:
+                for run, info in pickle.load(f).iteritems():
+                    if not isinstance(info, dict): continue # old entries stored under "isValid"
+                    for field, value in info.iteritems():
+                        self.set(run, field, value)
+
+    def __contains__(self, run):
+        return run in self.db
+
+    def get(self, run, field, default=None):
+        return self.db.get(run, {}).get(field, default)
+
+    def set(self, run, field, value):
+        if field not in fields:
+            raise KeyError("Unknown run info '{}'".format(field))
+        with self.lock:
+            info = self.db.setdefault(run, {})
+            if field in info and info[field] == value: return
+            info[field] = value
+            self.changed = True
+            self.revision += 1
+
+    def runs(self):
+        return sorted(self.db)
+
+    def items(self, field):
+        """Returns a dictionary run: value for all runs where field is known."""
+        with self.lock:
+            return dict((run, info[field]) for run, info in self.db.iteritems() if field in info)
+
+    def flush(self):
+        """Writes the database if it was modified. The file is replaced atomically."""
+        with self.lock:
+            if not self.changed: return
+            atomicFile.writeAtomic(self.dbName, lambda f: pickle.dump(self.db, f), "wb")
+            self.changed = False
+
+_openDBs = {}
+_openLock = threading.Lock() # the first call may come from several prefetch threads
+
+def getDB(dbName=defaultDBName):
+    """Returns the in-process instance of the database, loading it on first use."""
+    with _openLock:
+        if dbName not in _openDBs:
+            _openDBs[dbName] = RunDB(dbName)
+        return _openDBs[dbName]
+
+def flushAll():
+    for db in _openDBs.values():
+        db.flush()
+
+atexit.register(flushAll)
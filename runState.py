@@ -0,0 +1,85 @@
+#!/usr/bin/env python2
+# Download state of every run of every dataset, so that the run list from
+# DAS can be compared with it and exactly the missing runs are fetched.
+# Failed downloads are tried again with exponential backoff, and so are runs
+# the DQM GUI had no content for yet, with a longer delay.
+
+import os
+import json
+import time
+
+import atomicFile
+
+pending = "pending"
+downloaded = "downloaded"
+empty = "empty" # the DQM GUI had no content for the run
+failed = "failed"
+
+defaultStateName = "runStates.json"
+
+class RunStateIndex:
+    """
+    {dataset name: {run: {"state": ..., "attempts": failed attempts,
+    "time": time of the last attempt}}}, attempts counts the failed or empty
+    attempts in a row.
+    """
+    def __init__(self, filename=defaultStateName):
+        self.filename = filename
+        self.datasets = {}
+        self.changed = False
+        if filename and os.path.exists(filename):
+            with open(filename) as f:
+                data = json.load(f)
+            self.datasets = dict((name, dict((int(run), entry) for run, entry in runs.iteritems())) for name, runs in data.iteritems())
+
+    def isKnown(self, name):
+        return name in self.datasets
+
+    def get(self, name, run):
+        entry = self.datasets.get(name, {}).get(run)
+        return entry["state"] if entry else None
+
+    def runs(self, name, state=None):
+        return sorted(run for run, entry in self.datasets.get(name, {}).iteritems() if state is None or entry["state"] == state)
+
+    def set(self, name, run, state):
+        entry = self.datasets.setdefault(name, {}).setdefault(run, {"state": pending, "attempts": 0, "time": 0})
+        if state in [failed, empty]:
+            entry["attempts"] = entry["attempts"] + 1 if entry["state"] == state else 1
+        elif state != pending: entry["attempts"] = 0
+        entry["state"] = state
+        entry["time"] = time.time()
+        self.changed = True
+
+    def addRuns(self, name, runs):
+        """Adds runs from the DAS run list which are not yet known as pending."""
+        known = self.datasets.setdefault(name, {})
+        for run in runs:
+            if run not in known:
+                known[run] = {"state": pending, "attempts": 0, "time": 0}
+                self.changed = True
+
+    def toFetch(self, name, retryDelay=3600., maxAttempts=8, retryEmpty=False, emptyDelay=3*3600., maxEmptyAttempts=6, now=None):
+        """
+        Pending runs, failed runs whose last attempt is longer ago than
+        retryDelay doubled with every failed attempt, and likewise empty runs
+        with emptyDelay, since the DQM GUI may not have the content of a run
+        yet. retryEmpty fetches all empty runs right away.
+        """
+        if now is None: now = time.time()
+        isDue = lambda entry, delay, limit: entry["attempts"] < limit and now - entry["time"] >= delay * 2**(entry["attempts"]-1)
+        runs = []
+        for run, entry in self.datasets.get(name, {}).iteritems():
+            state = entry["state"]
+            if state == pending or (state == empty and retryEmpty):
+                runs.append(run)
+            elif state == failed and isDue(entry, retryDelay, maxAttempts):
+                runs.append(run)
+            elif state == empty and isDue(entry, emptyDelay, maxEmptyAttempts):
+                runs.append(run)
+        return sorted(runs)
+
+    def save(self):
+        if not self.changed: return
+        atomicFile.writeAtomic(self.filename, lambda f: json.dump(self.datasets, f, indent=0, sort_keys=True))
+        self.changed = False
@@ -0,0 +1,91 @@
+#!/usr/bin/env python2
+# Bulk run information against a stub das_client which answers run range
+# queries from a small table and logs every query.
+# Run with: python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import dasClient
+import runDB
+import makePlots
+
+dasStub = r'''
+import sys, re, json
+q = sys.argv[sys.argv.index("--query")+1]
+with open("queries.log", "a") as f: f.write(q + "\n")
+runs = {
+    279000: {"start_time": "2016-08-01 10:00:00", "end_time": "2016-08-01 12:00:00", "bfield": 3.8},
+    279005: {"start_time": "2016-08-01 14:00:00", "end_time": "2016-08-01 15:00:00", "bfield": 3.8},
+    279010: {"start_time": "2016-08-02 09:00:00", "end_time": None, "bfield": 0.0},
+}
+first, last = [int(x) for x in re.match(r"run between \[(\d+),(\d+)\]", q).groups()]
+data = []
+for run in sorted(runs):
+    if first <= run <= last:
+        entry = dict(runs[run], run_number=run)
+        # DAS gives a single entry as dict, several as list
+        data.append({"run": entry if run == 279010 else [entry]})
+print json.dumps({"status": "ok", "data": data})
+'''
+
+class RunInfoTest(unittest.TestCase):
+    def setUp(self):
+        self.oldDir = os.getcwd()
+        self.workDir = tempfile.mkdtemp(prefix="pixAliTest")
+        os.chdir(self.workDir)
+        stub = os.path.join(self.workDir, "das_client")
+        with open(stub, "w") as f:
+            f.write("#!" + sys.executable + dasStub)
+        os.chmod(stub, 0755)
+        self.oldDas, dasClient.dasCommand = dasClient.dasCommand, stub
+        self.db = runDB.getDB()
+
+    def tearDown(self):
+        runDB.flushAll()
+        runDB._openDBs.clear()
+        dasClient.dasCommand = self.oldDas
+        os.chdir(self.oldDir)
+        shutil.rmtree(self.workDir)
+
+    def queries(self):
+        if not os.path.exists("queries.log"): return []
+        with open("queries.log") as f:
+            return [q.split("|")[0].strip() for q in f.read().split("\n") if q]
+
+    def testPrefetchRanges(self):
+        self.assertEqual(dasClient.prefetchRunInfos([279000, 279005, 279010, 283000], db=self.db), 2)
+        self.assertEqual(self.queries(), ["run between [279000,279010]", "run between [283000,283000]"])
+        self.assertEqual(self.db.get(279005, "end_time"), "2016-08-01 15:00:00")
+        self.assertEqual(self.db.get(279010, "bfield"), "0.0")
+        # unknown to DAS, or without end time: invalid
+        self.assertEqual(self.db.get(283000, "end_time"), dasClient.invalid)
+        self.assertEqual(self.db.get(279010, "end_time"), dasClient.invalid)
+        # cached, invalid runs only with retryInvalid
+        self.assertEqual(dasClient.prefetchRunInfos([279000, 283000], db=self.db), 0)
+        self.assertEqual(dasClient.prefetchRunInfos([279000, 283000], db=self.db, retryInvalid=True), 1)
+
+    def testValidRunBefore(self):
+        dasClient.prefetchRunInfos([279005], db=self.db)
+        # the previous run is cached as valid, no query
+        self.assertEqual(dasClient.getValidRunBefore(279006, db=self.db), 279005)
+        self.assertEqual(len(self.queries()), 1)
+        # one query for the uncached runs of the block
+        self.assertEqual(dasClient.getValidRunBefore(279005, db=self.db), 279000)
+        self.assertEqual(self.queries()[1:], ["run between [278955,279004]"])
+        self.assertEqual(self.db.get(279003, "end_time"), dasClient.invalid)
+        self.assertEqual(dasClient.getValidRunBefore(279004, db=self.db), 279000)
+        self.assertEqual(len(self.queries()), 2)
+
+    def testGetTimeFallback(self):
+        # a run without end time gets the one of the previous valid run
+        self.assertEqual(makePlots.getTime(279003), "2016-08-01 12:00:00")
+        self.assertEqual(makePlots.getTime(279005), "2016-08-01 15:00:00")
+        self.assertEqual(self.queries(), ["run between [279003,279003]", "run between [278953,279002]", "run between [279005,279005]"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python2
+# Download path with a stub das_client and a local http server standing in
+# for the DQM GUI, and the parsing of DQM payloads which are no strict json.
+# ROOT is replaced by a minimal file writer, the tests are about the run
+# lists, the connections and the bookkeeping.
+# Run with: python -m unittest discover tests
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import threading
+import StringIO
+import SocketServer
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import downloadViaJson
+import dasClient
+import datasets
+import runState
+import runDB
+import paramStore
+
+dasStub = r'''
+import sys, json
+q = sys.argv[sys.argv.index("--query")+1]
+if "--format" in sys.argv: # run information
+    print json.dumps({"status": "ok", "data": []})
+elif q.startswith("run dataset="):
+    for r in [279000, 279001, 279002]: print r
+'''
+
+payload = json.dumps({"contents": [
+    {"obj": "Xpos", "properties": {"type": "TH1F"}, "rootobj": "00ff"},
+    {"obj": "Ypos", "properties": {"type": "TH1F"}, "rootobj": "00ff"},
+]})
+
+class DQMHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive as the DQM GUI
+    emptyRuns = ["279002"] # no content yet
+    stalledRuns = [] # the request is accepted, but nothing is sent until release is set
+    release = threading.Event()
+    def do_GET(self):
+        if any(run in self.path for run in self.stalledRuns):
+            self.release.wait()
+            self.close_connection = 1
+            return
+        empty = any(run in self.path for run in self.emptyRuns)
+        body = json.dumps({"contents": []}) if empty else payload
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, *args):
+        pass
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class FakeFile:
+    def __init__(self, name, option):
+        self.name = name
+        with open(name, "w") as f: f.write("x"*6000)
+    def cd(self): pass
+    def Close(self): pass
+
+class FakeHist:
+    def GetNbinsX(self): return 8
+    def GetBinContent(self, bin): return bin
+    def GetBinError(self, bin): return 0.1
+
+dataDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+class PayloadTest(unittest.TestCase):
+    def testNonStrictPayload(self):
+        # DQM GUI style payload, empty statistics are written as nan
+        with open(os.path.join(dataDir, "dqmPayloadSample.json")) as f:
+            body = f.read()
+        for chunkSize in [7, 1<<16]:
+            items = list(downloadViaJson.iterDqmContents(StringIO.StringIO(body), chunkSize))
+            self.assertEqual([item.get("obj") for item in items], [None, "Xpos", "Ypos", "Zpos"])
+            self.assertEqual(items[1]["rootobj"], "00ff0102")
+            self.assertNotEqual(items[2]["properties"]["stats"]["x"]["mean"], items[2]["properties"]["stats"]["x"]["mean"])
+
+    def testPythonLiteralPayload(self):
+        body = "{'contents': [{'obj': 'Xpos', 'rootobj': '00ff'}, {'obj': 'Ypos', 'rootobj': '[{'},]}"
+        items = list(downloadViaJson.iterDqmContents(StringIO.StringIO(body), 5))
+        self.assertEqual(items, [{'obj': 'Xpos', 'rootobj': '00ff'}, {'obj': 'Ypos', 'rootobj': '[{'}])
+
+    def testNoCodeEvaluated(self):
+        marker = os.path.join(tempfile.gettempdir(), "pixAliTestPWNED{}".format(os.getpid()))
+        exploit = "[c for c in ().__class__.__base__.__subclasses__() if c.__name__ == 'catch_warnings'][0]()" \
+            "._module.__builtins__['__import__']('os').system('echo PWNED > {}')".format(marker)
+        body = '{"contents": [{"obj": "Xpos", "rootobj": %s}]}' % exploit
+        try:
+            self.assertRaises(ValueError, list, downloadViaJson.iterDqmContents(StringIO.StringIO(body), 5))
+            self.assertFalse(os.path.exists(marker))
+        finally:
+            if os.path.exists(marker): os.remove(marker)
+
+    def testTruncatedPayload(self):
+        stream = StringIO.StringIO('{"contents": [{"obj": "Xpos", "rootobj": "00')
+        self.assertRaises(ValueError, list, downloadViaJson.iterDqmContents(stream, 5))
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.oldDir = os.getcwd()
+        self.workDir = tempfile.mkdtemp(prefix="pixAliTest")
+        os.chdir(self.workDir)
+        stub = os.path.join(self.workDir, "das_client")
+        with open(stub, "w") as f:
+            f.write("#!" + sys.executable + dasStub)
+        os.chmod(stub, 0755)
+        self.oldDas, dasClient.dasCommand = dasClient.dasCommand, stub
+        self.oldROOT, downloadViaJson.ROOT = downloadViaJson.ROOT, type("ROOT", (), {"TFile": FakeFile})
+        self.oldWriteItem = downloadViaJson.writeItem
+        downloadViaJson.writeItem = lambda item, objBuffer: FakeHist()
+        DQMHandler.emptyRuns = ["279002"]
+        DQMHandler.stalledRuns = []
+        DQMHandler.release = threading.Event()
+        self.oldTimeout = downloadViaJson.socketTimeout
+        self.server = ThreadingServer(("127.0.0.1", 0), DQMHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:{}/dqm/offline".format(self.server.server_port)
+
+    def tearDown(self):
+        DQMHandler.release.set()
+        downloadViaJson.socketTimeout = self.oldTimeout
+        self.server.shutdown()
+        self.server.server_close()
+        runDB.flushAll()
+        runDB._openDBs.clear()
+        dasClient.dasCommand = self.oldDas
+        downloadViaJson.ROOT = self.oldROOT
+        downloadViaJson.writeItem = self.oldWriteItem
+        os.chdir(self.oldDir)
+        shutil.rmtree(self.workDir)
+
+    def testGetRuns(self):
+        self.assertEqual(downloadViaJson.getRuns(datasets.registry["Run2016B"].dataset), [279000, 279001, 279002])
+
+    def testDownloadDatasets(self):
+        dset = datasets.registry["Run2016B"]
+        states = runState.RunStateIndex("runStates.json")
+        saved = downloadViaJson.downloadDatasets([dset], self.url, jobs=2, states=states)
+        self.assertEqual(saved, {"Run2016B": [279000, 279001, 279002]})
+        self.assertEqual(states.runs("Run2016B", runState.downloaded), [279000, 279001])
+        self.assertEqual(states.runs("Run2016B", runState.empty), [279002])
+        for run in saved["Run2016B"]:
+            self.assertTrue(os.path.exists(os.path.join(dset.outputFolder, "Run{}.root.json".format(run))))
+        # the parameters are in the store, the files need not be read again
+        store = paramStore.ParameterStore(dset.storeName)
+        self.assertEqual(store.row(279000)[2].tolist(), [8, 8, 0, 0, 0, 0])
+        runFromFilename = lambda f: int(os.path.basename(f)[3:-5])
+        outdated = paramStore.findOutdated(store, os.path.join(dset.outputFolder, "Run*.root"), runFromFilename)[1]
+        self.assertEqual(outdated, [])
+        # nothing left to fetch until the retry delay of the empty run has passed
+        self.assertEqual(downloadViaJson.downloadDatasets([dset], self.url, states=states), {"Run2016B": []})
+        DQMHandler.emptyRuns = []
+        states.datasets["Run2016B"][279002]["time"] -= 3*3600.
+        self.assertEqual(downloadViaJson.downloadDatasets([dset], self.url, states=states), {"Run2016B": [279002]})
+        self.assertEqual(states.runs("Run2016B", runState.downloaded), [279000, 279001, 279002])
+
+    def tasks(self, runs):
+        dset = datasets.registry["Run2016B"]
+        os.makedirs(dset.outputFolder)
+        return [downloadViaJson.DownloadTask(run, dset.dataset, dset.path, dset.outputFolder) for run in runs]
+
+    def testStalledServer(self):
+        # the stalled run fails after the socket timeout, the others are not held up
+        DQMHandler.stalledRuns = ["279001"]
+        downloadViaJson.socketTimeout = 0.3
+        results = downloadViaJson.downloadTasks(self.tasks([279000, 279001]), self.url, jobs=2, maxRetries=1, retryDelay=0.)
+        self.assertEqual(sorted((task.run, state) for task, state in results.iteritems()), [(279000, runState.downloaded), (279001, runState.failed)])
+
+    def testWriteError(self):
+        # an entry which cannot be written fails only its own run
+        calls = []
+        def writeItem(item, objBuffer):
+            calls.append(item)
+            if len(calls) == 1: raise ValueError("unknown type")
+            return FakeHist()
+        downloadViaJson.writeItem = writeItem
+        results = downloadViaJson.downloadTasks(self.tasks([279000, 279001]), self.url, jobs=1)
+        self.assertEqual(sorted((task.run, state) for task, state in results.iteritems()), [(279000, runState.failed), (279001, runState.downloaded)])
+        self.assertEqual(len(calls), 3) # the rest of the failed run is skipped
+        self.assertFalse(os.path.exists(downloadViaJson.rootFileName(279000, datasets.registry["Run2016B"].outputFolder)))
+
+if __name__ == "__main__":
+    unittest.main()
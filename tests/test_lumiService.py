@@ -0,0 +1,85 @@
+#!/usr/bin/env python2
+# Incremental luminosity queries against a stub brilcalc, which answers from
+# the table in lumis.json and logs the queried ranges.
+# Run with: python -m unittest discover tests
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lumiService
+import runDB
+
+brilcalcStub = r'''
+import sys, json
+args = sys.argv[1:]
+first = int(args[args.index("--begin")+1])
+last = int(args[args.index("--end")+1]) if "--end" in args else None
+with open("queries.log", "a") as f: f.write("{} {}\n".format(first, last))
+with open("lumis.json") as f: lumis = dict((int(r), l) for r, l in json.load(f).iteritems())
+print "#run:fill,time,nls,ncms,delivered(/fb),recorded(/fb)"
+for run in sorted(lumis):
+    if run >= first and (last is None or run <= last):
+        print "{}:5000,08/01/16 10:00:00,10,10,{},{}".format(run, lumis[run], lumis[run])
+'''
+
+class LumiTest(unittest.TestCase):
+    def setUp(self):
+        self.oldDir = os.getcwd()
+        self.workDir = tempfile.mkdtemp(prefix="pixAliTest")
+        os.chdir(self.workDir)
+        stub = os.path.join(self.workDir, "brilcalc")
+        with open(stub, "w") as f:
+            f.write("#!" + sys.executable + brilcalcStub)
+        os.chmod(stub, 0755)
+        self.oldBrilcalc, lumiService.brilcalcCommand = lumiService.brilcalcCommand, stub
+        lumiService.expireHorizon()
+        self.setLumis({279000: 0.1, 279005: 0.2, 279010: 0.3, 279015: 0.4, 279020: 0.5})
+        self.db = runDB.getDB()
+
+    def tearDown(self):
+        runDB.flushAll()
+        runDB._openDBs.clear()
+        lumiService.expireHorizon()
+        lumiService.brilcalcCommand = self.oldBrilcalc
+        os.chdir(self.oldDir)
+        shutil.rmtree(self.workDir)
+
+    def setLumis(self, lumis):
+        with open("lumis.json", "w") as f:
+            json.dump(lumis, f)
+
+    def queries(self):
+        with open("queries.log") as f:
+            return [line for line in f.read().split("\n") if line]
+
+    def testIncrementalQueries(self):
+        # first call: everything from minRun on
+        self.assertAlmostEqual(lumiService.integratedLumi(279000, db=self.db), 1.5)
+        self.assertEqual(self.queries(), ["279000 None"])
+        # repeat call in the same process: no query
+        self.assertAlmostEqual(lumiService.integratedLumi(279005, db=self.db), 1.4)
+        self.assertEqual(len(self.queries()), 1)
+        # next horizon: the last three cached runs again, inclusive, and newer ones
+        self.setLumis({279000: 0.1, 279005: 0.2, 279010: 0.3, 279015: 0.4, 279020: 0.6, 279025: 0.7})
+        lumiService.expireHorizon()
+        self.assertAlmostEqual(lumiService.integratedLumi(279000, db=self.db), 2.3)
+        self.assertEqual(self.queries()[1:], ["279010 None"])
+
+    def testBackfill(self):
+        lumiService.updateLumi(279000, self.db)
+        # runs before the first cached run, 278000 has no stable beams
+        self.setLumis({278500: 1.0, 279000: 0.1})
+        self.assertAlmostEqual(lumiService.integratedLumi(278000, 278999, db=self.db), 1.0)
+        self.assertEqual(self.queries(), ["279000 None", "278000 278999"])
+        # the zero marker makes the range count as covered
+        self.assertEqual(self.db.get(278000, "lumi"), 0.)
+        self.assertAlmostEqual(lumiService.integratedLumi(278000, 278999, db=self.db), 1.0)
+        self.assertEqual(len(self.queries()), 2)
+
+if __name__ == "__main__":
+    unittest.main()
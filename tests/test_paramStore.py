@@ -0,0 +1,47 @@
+#!/usr/bin/env python2
+# Two processes writing the same parameter store, as the download and
+# watch.py do.
+# Run with: python -m unittest discover tests
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import paramStore
+
+def filledRow(value):
+    content, error, nbins = paramStore.emptyRow()
+    content += value
+    nbins += paramStore.nBins
+    return content, error, nbins
+
+class MergeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "paramStore.npz")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testSaveMergesRunsOnDisk(self):
+        first = paramStore.ParameterStore(self.filename)
+        first.set(1, *filledRow(1.) + (10., 100))
+        first.set(2, *filledRow(2.) + (10., 100))
+        first.save()
+        second = paramStore.ParameterStore(self.filename)
+        first.set(3, *filledRow(3.) + (10., 100))
+        first.set(2, *filledRow(5.) + (20., 100)) # file of run 2 was downloaded again
+        first.save()
+        second.set(4, *filledRow(4.) + (10., 100))
+        second.keepOnly([2, 3, 4]) # the file of run 1 was deleted
+        second.save()
+        store = paramStore.ParameterStore(self.filename)
+        self.assertEqual(list(store.runs), [2, 3, 4])
+        self.assertEqual([float(r.content[0][0]) for r in store.records()], [5., 3., 4.])
+        self.assertTrue(store.isCurrent(2, 20., 100))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,12 @@
 #!/usr/bin/env python2
 
-import ROOT
-import subprocess
+from lazyROOT import ROOT
 import re
-import os
 import glob
-import pickle
+
+import runDB
+import dasClient
+import contentIndex
 
 def runFromFilename(filename):
     m = re.match(".*Run(\d+).root", filename)
@@ -15,32 +16,29 @@ def runFromFilename(filename):
         print "Could not find run number"
         return 0
 
-def getRunStartTime(run):
+def getRunStartTime(run, db=None):
     #returs a string similar to 2016-06-16 23:30:32
-    return subprocess.check_output(["das_client.py --limit=0 --query=\"run={} | grep run.start_time\"".format(run)], shell=True)
+    return dasClient.getRunInfo(run, "start_time", db)
 
 def isValid(filename):
+    entry = contentIndex.lookup(filename)
+    if entry: return contentIndex.isValid(entry)
+    # downloaded before the content index existed
     f = ROOT.TFile(filename)
     valid = len(f.GetListOfKeys()) == 6
     f.Close()
     return valid
 
-def updateDB():
-    dbName = "runInfo.pkl"
-    infos = {}
-    if os.path.exists(dbName):
-        with open(dbName) as f:
-            infos = pickle.load(f)
-
-    for f in glob.glob("root-files/Run*.root"):
+def updateDB(dbName=runDB.defaultDBName):
+    db = runDB.getDB(dbName)
+    files = glob.glob("root-files/Run*.root")
+    dasClient.prefetchRunInfos([runFromFilename(f) for f in files], ["start_time"], db)
+    for f in files:
         run = runFromFilename(f)
-        if run not in infos:
-            infos[run] = {}
-            infos[run]["start_time"] = getRunStartTime(run)
-            infos["isValid"] = isValid(f)
-
-    with open(dbName, "wb") as f:
-        pickle.dump(infos, f)
+        if db.get(run, "isValid") is None:
+            db.set(run, "start_time", getRunStartTime(run, db))
+            db.set(run, "isValid", isValid(f))
+    db.flush()
 
 if __name__ == "__main__":
     updateDB()
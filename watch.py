@@ -0,0 +1,113 @@
+#!/usr/bin/env python2
+# Long running alternative to the daily cron job: polls root-files/ and
+# processes every newly arrived run right away. ROOT, the style, the
+# parameter store and the run database stay loaded between the polls, so a
+# new run costs reading its file, drawing it and updating the summary plots.
+# Usage: python watch.py [--interval 60] [--mail "a@cern.ch b@cern.ch"]
+
+import os
+import sys
+import time
+import argparse
+
+import makePlots
+import paramStore
+import renderManifest
+import runDB
+import dasClient
+import lumiService
+import plotOutput
+import externalCommands
+
+updateTags = ["TrackerAlignment_PCL_byRun_v0_express"]
+minRun = 278887
+
+class Watcher:
+    def __init__(self, searchPath="root-files/Run*.root", jobs=1, settle=30., mail=None):
+        self.searchPath = searchPath
+        self.jobs = jobs
+        self.settle = settle # seconds without change before a file is read
+        self.mail = mail
+        self.store = paramStore.ParameterStore()
+        self.storeMTime = self.storeModificationTime()
+        self.manifest = makePlots.getManifest()
+        # forked once, before the plot writer and metadata threads are started
+        self.pool = makePlots.startRenderPool(jobs, self.store.filename) if jobs > 1 else None
+
+    def storeModificationTime(self):
+        return os.path.getmtime(self.store.filename) if os.path.exists(self.store.filename) else None
+
+    def reloadStore(self):
+        # the download adds the parameters of new runs to the store on disk
+        if self.storeModificationTime() != self.storeMTime:
+            self.store = paramStore.ParameterStore(self.store.filename)
+            self.storeMTime = self.storeModificationTime()
+
+    def isSettled(self, filename, stat):
+        # the download may still be writing the newest files, they are read with a later poll
+        return time.time() - stat.st_mtime > self.settle
+
+    def poll(self):
+        """Processes new or changed files, returns the runs which were drawn."""
+        self.reloadStore()
+        updated = paramStore.updateStore(self.store, self.searchPath, makePlots.readParameters, makePlots.runFromFilename, ready=self.isSettled)
+        self.store.save()
+        self.storeMTime = self.storeModificationTime()
+        runHashes, newRuns = makePlots.findNewRuns(self.store, self.manifest)
+        series = makePlots.ParameterSeries(self.store.records(), minRun)
+        seriesHash = renderManifest.hashInputs(series.runs, series.content, series.valid)
+        # a new IOV of the update tags redraws the summary plots as well
+        summaryCurrent = self.manifest.isCurrent("series", makePlots.summaryHash(seriesHash, makePlots.knownUpdateRuns(updateTags, minRun+1)))
+        if not updated and not newRuns and summaryCurrent: return []
+        self.reportStatus(newRuns)
+        makePlots.renderNewRuns(newRuns, runHashes, self.manifest, self.jobs, self.store, self.pool)
+        if not summaryCurrent:
+            dasClient.prefetchRunInfos([int(r) for r in series.runs])
+            lumiService.expireHorizon()
+            updateRuns, updateTimes = makePlots.getUpdateArrays(updateTags, minRun+1)
+            makePlots.drawSummaryPlots(series, seriesHash, updateRuns, updateTimes, self.manifest)
+            plotOutput.publishDeferred()
+            self.manifest.record("series", makePlots.summaryHash(seriesHash, updateRuns), [])
+        self.manifest.save()
+        runDB.flushAll()
+        return newRuns
+
+    def close(self):
+        # called after an interrupt, nothing is rendering then
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+
+    def reportStatus(self, runs):
+        cutStatus = makePlots.cutStatusSummary(self.store)
+        for run in runs:
+            if run not in cutStatus: continue
+            print "Run {}: {}".format(run, cutStatus[run])
+            if cutStatus[run] == "fail" and self.mail:
+                makePlots.sendMail(self.mail, "[PCL] Cuts exceeded", "Run: {}".format(run))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--interval", type=float, default=60, help="Seconds between two polls")
+    parser.add_argument("--settle", type=float, default=30, help="Seconds a file has to be unchanged before it is read")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="Number of processes drawing the plots of new runs")
+    parser.add_argument("--mail", help="Addresses notified if a run exceeds the cuts")
+    parser.add_argument("--timeout", type=float, default=externalCommands.defaultTimeout, help="Timeout in seconds for each external lookup")
+    args = parser.parse_args()
+    externalCommands.defaultTimeout = args.timeout
+
+    watcher = Watcher(jobs=args.jobs, settle=args.settle, mail=args.mail)
+    while True:
+        try:
+            watcher.poll()
+        except KeyboardInterrupt:
+            break
+        except Exception as e:
+            # e.g. DAS or conddb not reachable, try again with the next poll
+            print "Processing failed: {} {}".format(type(e).__name__, e)
+        sys.stdout.flush()
+        try:
+            time.sleep(args.interval)
+        except KeyboardInterrupt:
+            break
+    watcher.close()